@@ -1,5 +1,6 @@
 import abc
 import enum
+import functools
 import re
 import sys
 import typing
@@ -218,7 +219,7 @@ VALNAME = pe.Terminal('VALNAME', "[A-Z][a-zA-Z0-9_]*", str, priority=8)
 
 
 def make_keyword(image):
-    return pe.Terminal(image, image, lambda name: None,
+    return pe.Terminal(image, image, None,
                        re_flags=re.IGNORECASE, priority=10)
 
 
@@ -239,10 +240,10 @@ NFuncBody, NOperators, NOperator, NDeclOperator, NValName, NAssignOperator, NFun
         .split())
 NCondOperator, NCompBranches, NPreConditionLoop, NLoopStep, NPostConditionLoop, NReturnOperator = \
     map(pe.NonTerminal, 'CondOperator CompBranches PreConditionLoop LoopStep PostConditionLoop ReturnOperator'.split())
-NAssertOperator, NExpr, NLogCompOp, NLogCompExpr, NLogOp, NLogExpr, NCmpOp, NCmpExpr, NArithmOp = \
-    map(pe.NonTerminal, 'AssertOperator Expr LogCompOn LogCompExpr LogOp LogExpr CmpOp CmpExpr ArithmOp'.split())
-NArithmExpr, NMulOp, NMulExpr, NDegOp, NDegExpr, NUnaryOp, NUnaryExpr, NNewExpr, NArrVal = \
-    map(pe.NonTerminal, 'ArithmExpr MulOp MulExpr DegOp DegExpr UnaryOp UnaryExpr NewExpr ArrVal'.split())
+NAssertOperator, NExpr, NLogCompOp, NLogOp, NCmpOp, NArithmOp, NMulOp, NDegOp = \
+    map(pe.NonTerminal, 'AssertOperator Expr LogCompOn LogOp CmpOp ArithmOp MulOp DegOp'.split())
+NUnaryOp, NUnaryExpr, NNewExpr, NArrVal = \
+    map(pe.NonTerminal, 'UnaryOp UnaryExpr NewExpr ArrVal'.split())
 
 NProgram |= NFuncs
 NFuncs |= NFuncs, NFunc, lambda funcs, func: funcs + [func]
@@ -303,17 +304,20 @@ NReturnOperator |= KV_RETURN, NExpr
 
 NAssertOperator |= KV_ASSERT, NExpr
 
-NExpr |= NLogCompExpr
-NExpr |= NLogCompExpr, NLogCompOp, NLogCompExpr, BinOpExpression
+NExpr |= NExpr, NLogCompOp, NExpr, pe.Prec(KV_OR), BinOpExpression
+NExpr |= NExpr, NLogOp, NExpr, pe.Prec(KV_AND), BinOpExpression
+NExpr |= NExpr, NCmpOp, NExpr, pe.Prec('='), BinOpExpression
+NExpr |= NExpr, NArithmOp, NExpr, pe.Prec('+'), BinOpExpression
+NExpr |= NExpr, NMulOp, NExpr, pe.Prec('*'), BinOpExpression
+NExpr |= NExpr, NDegOp, NExpr, pe.Prec('**'), BinOpExpression
+NExpr |= NUnaryExpr
+# NExpr |= '-', NExpr, pe.Prec('**'), lambda t: UnOpExpression('-', t)
+
 NLogCompOp |= KV_OR, lambda: 'or'
 NLogCompOp |= KV_XOR, lambda: 'xor'
 
-NLogCompExpr |= NLogExpr
-NLogCompExpr |= NLogCompExpr, NLogOp, NLogExpr, BinOpExpression
 NLogOp |= KV_AND, lambda: 'and'
 
-NLogExpr |= NCmpExpr
-NLogExpr |= NLogExpr, NCmpOp, NCmpExpr, BinOpExpression
 NCmpOp |= '=', lambda: '='
 NCmpOp |= '<>', lambda: '<>'
 NCmpOp |= '<', lambda: '<'
@@ -321,24 +325,15 @@ NCmpOp |= '>', lambda: '>'
 NCmpOp |= '<=', lambda: '<='
 NCmpOp |= '>=', lambda: '>='
 
-NCmpExpr |= NArithmExpr
-NCmpExpr |= NCmpExpr, NArithmOp, NArithmExpr, BinOpExpression
 NArithmOp |= '+', lambda: '+'
 NArithmOp |= '-', lambda: '-'
 
-NArithmExpr |= NMulExpr
-NArithmExpr |= NArithmExpr, NMulOp, NMulExpr, BinOpExpression
 NMulOp |= '*', lambda: '*'
 NMulOp |= '/', lambda: '/'
 NMulOp |= KV_MOD, lambda: 'mod'
 
-NMulExpr |= NDegExpr
-NMulExpr |= NDegExpr, NDegOp, NMulExpr, BinOpExpression
 NDegOp |= '**', lambda: '**'
 
-NDegExpr |= NUnaryExpr
-# NDegExpr |= '-', NUnaryExpr, lambda t: UnOpExpression('-', t)
-
 NUnaryExpr |= ANYNAME
 NUnaryExpr |= NArrVal
 NUnaryExpr |= NFuncCallOperator
@@ -356,20 +351,27 @@ NType |= KV_BOOL, lambda: Type.Boolean
 NType |= KV_CHAR, lambda: Type.Char
 NType |= NType, KV_ARRAY, lambda t: "array of {}".format(t)
 
-p = pe.Parser(NProgram)
-assert p.is_lalr_one()
-
-p.add_skipped_domain('\\s')
-
-from pprint import pprint
-import sys
-
-for filename in sys.argv[1:]:
-    try:
-        with open(filename) as f:
-            tree = p.parse(f.read())
+@functools.cache
+def parser():
+    p = pe.Parser(NProgram,
+                  precedence=[('nonassoc', KV_OR, KV_XOR),
+                              ('left', KV_AND),
+                              ('left', '=', '<>', '<', '>', '<=', '>='),
+                              ('left', '+', '-'),
+                              ('left', '*', '/', KV_MOD),
+                              ('right', '**')])
+    assert p.is_lalr_one()
+
+    p.add_skipped_domain('\\s')
+    return p
+
+
+if __name__ == '__main__':
+    for filename in sys.argv[1:]:
+        try:
+            tree = parser().parse_file(filename)
             pprint(tree)
-    except pe.Error as e:
-        print(f'Ошибка {e.pos}: {e.message}')
-    except Exception as e:
-        print(e)
+        except pe.Error as e:
+            print(f'Ошибка {e.pos}: {e.message}')
+        except Exception as e:
+            print(e)
@@ -1,17 +1,41 @@
 import abc
+import array
+import bisect
+import codecs
 import collections
+import collections.abc
+import contextlib
 import dataclasses
+import functools
+import hashlib
+import io
+import itertools
+import marshal
+import mmap
+import os
 import re
 import sys
+import time
+import tracemalloc
+
+try:
+    import re._parser as sre_parse
+    import re._constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
 
 
 __all__ = '''
 Terminal
 ExAction
+Prec
 NonTerminal
 EOF_SYMBOL
 Position
 Fragment
+LineIndex
+TextEdit
 Parser
 Error
 '''.split()
@@ -22,7 +46,13 @@ class Symbol:
 
 
 class BaseTerminal(Symbol):
-    pass
+    func = None
+
+    def first_chars(self):
+        first = self.first_set()
+        if first is None or not all(isinstance(item, str) for item in first):
+            return None
+        return first
 
 
 class Terminal(BaseTerminal):
@@ -33,20 +63,33 @@ class Terminal(BaseTerminal):
         self.priority = priority
         self.re = re.compile(regex, re_flags)
 
+        try:
+            self.bytes_re = re.compile(regex.encode('ascii'), self.re.flags & ~re.UNICODE)
+        except (UnicodeEncodeError, re.error):
+            self.bytes_re = None
+
     def __repr__(self):
         return f'Terminal({self.name!r},{self.regex!r},{self.func!r})'
 
     def __str__(self):
         return self.name
 
+    def first_set(self):
+        return regex_first_set(self.regex, self.re.flags)
+
+    def keeps_lines(self):
+        return regex_keeps_lines(self.regex, self.re.flags)
+
     def match(self, string, pos):
-        m = self.re.match(string, pos)
+        if type(string) is str:
+            m = self.re.match(string, pos)
+        else:
+            m = self.bytes_re.match(string, pos)
         if m != None:
             begin, end = m.span()
-            attrib = self.func(string[begin:end])
-            return end - begin, attrib
+            return end - begin
         else:
-            return 0, None
+            return 0
 
 
 class LiteralTerminal(BaseTerminal):
@@ -54,6 +97,11 @@ class LiteralTerminal(BaseTerminal):
         self.image = image
         self.priority = 10
 
+        try:
+            self.bytes_image = image.encode('ascii')
+        except UnicodeEncodeError:
+            self.bytes_image = None
+
     def __hash__(self):
         return hash(self.image)
 
@@ -66,11 +114,21 @@ class LiteralTerminal(BaseTerminal):
     def __str__(self):
         return repr(self.image)
 
+    def first_set(self):
+        return frozenset(self.image[:1])
+
+    def keeps_lines(self):
+        return '\n' not in self.image[:-1]
+
     def match(self, string, pos):
-        if string.startswith(self.image, pos):
-            return len(self.image), None
+        if type(string) is str:
+            found = string.startswith(self.image, pos)
+        else:
+            found = string[pos:pos + len(self.bytes_image)] == self.bytes_image
+        if found:
+            return len(self.image)
         else:
-            return 0, None
+            return 0
 
 
 class SpecTerminal(BaseTerminal):
@@ -91,22 +149,38 @@ FREE_SYMBOL = SpecTerminal('#')
 class ErrorTerminal(BaseTerminal):
     priority = -1
 
+    @staticmethod
+    def first_set():
+        return None
+
+    @staticmethod
+    def keeps_lines():
+        return True
+
     @staticmethod
     def match(string, pos):
         assert pos < len(string)
-        return 1, ErrorTerminal
+        return 1
 
 
 @dataclasses.dataclass(frozen = True)
 class ExAction():
     callee : object
+    simple : object = dataclasses.field(default=None, compare=False)
 
     @staticmethod
     def wrap_simple_action(simple_fold):
         def extended_action(attrs, coords, res_coord):
             return simple_fold(*attrs)
 
-        return ExAction(extended_action)
+        return ExAction(extended_action, simple_fold)
+
+
+@dataclasses.dataclass(frozen = True)
+class Prec:
+    # %prec: the rule takes the precedence of the given terminal or of a
+    # name declared only in the precedence list
+    symbol : object
 
 
 class NonTerminal(Symbol):
@@ -114,6 +188,7 @@ class NonTerminal(Symbol):
         self.name = name
         self.productions = []
         self.lambdas = []
+        self.precs = []
 
     def __repr__(self):
         return 'NonTerminal(' + repr(self.name) + ')'
@@ -153,9 +228,13 @@ class NonTerminal(Symbol):
             self |= lambda: None
         elif isinstance(other, tuple) and isinstance(other[-1], ExAction):
             *symbols, fold = other
-            symbols = [self.__wrap_literals(sym) for sym in symbols]
+            precs = [sym.symbol for sym in symbols if isinstance(sym, Prec)]
+            if len(precs) > 1:
+                raise Exception('Bad rule')
+            symbols = [self.__wrap_literals(sym) for sym in symbols if not isinstance(sym, Prec)]
             self.productions.append(symbols)
             self.lambdas.append(fold)
+            self.precs.append(self.__wrap_literals(precs[0]) if len(precs) > 0 else None)
         elif isinstance(other, tuple) and is_callable(other[-1]):
             self |= other[:-1] + (ExAction.wrap_simple_action(other[-1]),)
         elif isinstance(other, tuple):
@@ -178,6 +257,10 @@ class NonTerminal(Symbol):
         else:
             raise RuntimeError('__default_fold', args)
 
+    @staticmethod
+    def is_default_fold(fold):
+        return isinstance(fold, ExAction) and fold.simple is NonTerminal.__default_fold
+
     def enum_rules(self):
         return zip(self.productions, self.lambdas)
 
@@ -204,20 +287,123 @@ class Position:
         return f'({self.line}, {self.col})'
 
 
-@dataclasses.dataclass(frozen = True)
+class LineIndex:
+    def __init__(self, text=''):
+        self.__pending = text
+        self.__scanned = 0
+        self.__line_starts = [0]
+
+    def __scan(self, text):
+        newline_char = '\n' if isinstance(text, str) else b'\n'
+        newline = text.find(newline_char)
+        while newline >= 0:
+            self.__line_starts.append(self.__scanned + newline + 1)
+            newline = text.find(newline_char, newline + 1)
+        self.__scanned += len(text)
+
+    def build(self):
+        if self.__pending is not None:
+            self.__scan(self.__pending)
+            self.__pending = None
+
+    def feed(self, chunk):
+        self.build()
+        self.__scan(chunk)
+
+    def position(self, offset):
+        self.build()
+        line = bisect.bisect_right(self.__line_starts, offset)
+        return Position(offset, line, offset - self.__line_starts[line - 1] + 1)
+
+
 class Fragment:
-    start : Position
-    following : Position
+    __slots__ = ('lines', 'begin', 'end')
+
+    def __init__(self, lines, begin, end):
+        self.lines = lines
+        self.begin = begin
+        self.end = end
+
+    @property
+    def start(self):
+        return self.lines.position(self.begin)
+
+    @property
+    def following(self):
+        return self.lines.position(self.end)
+
+    def __eq__(self, other):
+        return type(self) == type(other) \
+                and (self.begin, self.end) == (other.begin, other.end)
+
+    def __hash__(self):
+        return hash((self.begin, self.end))
+
+    def __repr__(self):
+        return f'Fragment({self.start!r},{self.following!r})'
 
     def __str__(self):
         return f'{self.start}-{self.following}'
 
 
 @dataclasses.dataclass
+class ColumnarTokens:
+    terminals : tuple
+    types : array.array
+    starts : array.array
+    ends : array.array
+    attr_indices : array.array
+    attrs : list
+    lines : LineIndex = dataclasses.field(default=None, repr=False, compare=False)
+
+    def __len__(self):
+        return len(self.types)
+
+    def attr(self, index):
+        pos = bisect.bisect_left(self.attr_indices, index)
+        if pos < len(self.attr_indices) and self.attr_indices[pos] == index:
+            return self.attrs[pos]
+        return None
+
+    def token(self, index):
+        return Token(self.terminals[self.types[index]], self.starts[index],
+                     self.ends[index], self.attr(index), self.lines)
+
+
 class Token:
-    type : BaseTerminal
-    pos : Fragment
-    attr : object
+    __slots__ = ('type', 'start', 'end', 'lines', '__attr', '__lexeme')
+
+    def __init__(self, type, start, end, attr=None, lines=None, lexeme=None):
+        self.type = type
+        self.start = start
+        self.end = end
+        self.lines = lines
+        self.__attr = attr
+        self.__lexeme = lexeme
+
+    @property
+    def attr(self):
+        if self.__lexeme is not None:
+            self.__attr = self.type.func(self.__lexeme)
+            self.__lexeme = None
+        return self.__attr
+
+    @property
+    def pos(self):
+        return Fragment(self.lines, self.start, self.end)
+
+    def moved(self, delta, lines):
+        return Token(self.type, self.start + delta, self.end + delta, self.__attr, lines,
+                     self.__lexeme)
+
+    def __eq__(self, other):
+        return type(self) == type(other) \
+                and (self.type, self.start, self.end, self.attr) \
+                    == (other.type, other.start, other.end, other.attr)
+
+    def __repr__(self):
+        return f'Token(type={self.type!r}, start={self.start!r}, ' \
+                + f'end={self.end!r}, attr={self.attr!r})'
 
     def __str__(self):
         if self.attr is not None:
@@ -226,81 +412,331 @@ class Token:
             return str(self.type)
 
 
+class TokenSequence(collections.abc.Sequence):
+    # Tokens of an edited text kept as pieces of older token lists: a piece
+    # (tokens, begin, end, delta) stands for tokens[begin:end] moved by delta,
+    # and a token is moved, onto the current line index, only when it is read. So relexing an edit costs
+    # the tokens around it, not a copy of every token behind it.
+    def __init__(self, pieces, lines):
+        self.pieces = [piece for piece in pieces if piece[1] < piece[2]]
+        self.lines = lines
+        self.bounds = list(itertools.accumulate(end - begin
+                                                for tokens, begin, end, delta in self.pieces))
+
+    @staticmethod
+    def pieces_of(tokens, begin, end, delta):
+        if not isinstance(tokens, TokenSequence):
+            return [(tokens, begin, end, delta)]
+        pieces, piece_start = [], 0
+        for (piece_tokens, piece_begin, piece_end, piece_delta), bound \
+                in zip(tokens.pieces, tokens.bounds):
+            lo, hi = max(begin, piece_start), min(end, bound)
+            if lo < hi:
+                pieces.append((piece_tokens, piece_begin + lo - piece_start,
+                               piece_begin + hi - piece_start, piece_delta + delta))
+            piece_start = bound
+        return pieces
+
+    def __len__(self):
+        return self.bounds[-1] if len(self.bounds) > 0 else 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('token index out of range')
+        piece_id = bisect.bisect_right(self.bounds, index)
+        tokens, begin, end, delta = self.pieces[piece_id]
+        token = tokens[begin + index - (self.bounds[piece_id - 1] if piece_id > 0 else 0)]
+        return token.moved(delta, self.lines)
+
+    def __iter__(self):
+        for tokens, begin, end, delta in self.pieces:
+            for i in range(begin, end):
+                yield tokens[i].moved(delta, self.lines)
+
+    def __eq__(self, other):
+        return isinstance(other, (list, TokenSequence)) and list(self) == list(other)
+
+
+@dataclasses.dataclass(frozen = True)
+class TextEdit:
+    start : int
+    end : int
+    text : str
+
+    @property
+    def delta(self):
+        return len(self.text) - (self.end - self.start)
+
+    def apply(self, text):
+        return text[:self.start] + self.text + text[self.end:]
+
+
+@dataclasses.dataclass(frozen = True)
+class LexerCheckpoint:
+    offset : int
+    pos : Position
+
+
 class LrZeroItemTableEntry:
     def __init__(self):
         self.propagates_to = set()
-        self.lookaheads = set()
+        self.lookaheads = 0
 
     def __repr__(self):
         pattern = '{ propagatesTo: %s, lookaheads: %s }'
         return pattern % (repr(self.propagates_to), repr(self.lookaheads))
 
 
-Shift = collections.namedtuple('Shift', 'state')
-Reduce = collections.namedtuple('Reduce', 'rule')
-Accept = collections.namedtuple('Accept', '')
+# not namedtuples: Shift(5) and Reduce(5) would be equal and one of them
+# silently lost in an action set
+@dataclasses.dataclass(frozen = True)
+class Shift:
+    state : int
+
+
+@dataclasses.dataclass(frozen = True)
+class Reduce:
+    rule : int
+
+
+@dataclasses.dataclass(frozen = True)
+class Accept:
+    pass
+
+
+@dataclasses.dataclass
+class BuildPhase:
+    name : str
+    seconds : float
+    peak_memory : object = None
+
+
+class BuildStats:
+    # Wall time of the table construction phases, their peak memory above
+    # what was allocated before them when trace_memory is set, and sizes
+    # the phases produce
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.phases = []
+        self.counts = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] - start_memory if tracing else None
+            self.phases.append(BuildPhase(name, seconds, peak))
+
+    def count(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    @property
+    def seconds(self):
+        return sum(phase.seconds for phase in self.phases)
 
 
 class ParsingTable:
-    def __init__(self, gr):
+    ACTION_TYPES = (Shift, Reduce, Accept)
+
+    def __init__(self, gr, cached=None, symbols=None):
         self.grammar = gr
 
         self.terminals = ()
         self.nonterms = ()
         self.__ccol = ()
+        self.__encoded_ccol = None
+        # (parent state, symbol) of the transition that first reached each
+        # state but the initial one, and all transitions of a fresh build
+        self.__access = None
+        self.__transitions = None
         self.n_states = 0
 
-        self.goto = ()
-        self.action = ()
+        self.__goto = ()
+        self.__action = ()
+        # (state, terminal) cells made errors by %nonassoc, they must not
+        # be replaced with a default reduction in the runtime tables
+        self.__errors = set()
+        # rows loaded from the cache are decoded when first asked for: the
+        # parser runs on the runtime tables and needs them for errors only
+        self.__cached_rows = None
+
+        if cached is None:
+            self.__setup_from_grammar(self.grammar)
+        else:
+            self.__setup_from_cache(self.grammar, cached, symbols)
+
+    def to_cache(self, symbols):
+        ids = {symbol: i for i, symbol in enumerate(symbols)}
+        encode = lambda action: (self.ACTION_TYPES.index(type(action)),) + dataclasses.astuple(action)
+        action = tuple(tuple((ids[t], tuple(map(encode, e))) for t, e in row.items()
+                             if len(e) > 0 or (state_id, t) in self.errors)
+                       for state_id, row in enumerate(self.action))
+        goto = tuple(tuple((ids[nt], sid) for nt, sid in row.items() if sid is not None)
+                     for row in self.goto)
+        access = tuple((parent, ids[symbol]) for parent, symbol in self.__access) \
+            if self.__access is not None else None
+        return self.n_states, action, goto, access
 
-        self.__setup_from_grammar(self.grammar)
+    @property
+    def action(self):
+        if self.__cached_rows is not None:
+            self.__decode_cached_rows()
+        return self.__action
 
-    def __setup_from_grammar(self, gr):
+    @property
+    def goto(self):
+        if self.__cached_rows is not None:
+            self.__decode_cached_rows()
+        return self.__goto
+
+    @property
+    def errors(self):
+        if self.__cached_rows is not None:
+            self.__decode_cached_rows()
+        return self.__errors
+
+    @property
+    def __item_sets(self):
+        if self.__encoded_ccol is not None:
+            code, item_sets = self.__encoded_ccol
+            self.__ccol = tuple(map(code.decode_item_set, item_sets))
+            self.__encoded_ccol = None
+        elif self.__ccol is None:
+            self.__ccol = self.__rebuild_item_sets()
+        return self.__ccol
+
+    def __rebuild_item_sets(self):
+        # The cache keeps no item sets, they take longer to load than to
+        # build. State numbers follow the terminal order, which changes from
+        # run to run, so each cached state is found in a fresh build along
+        # the transition that first reached it.
+        fresh = ParsingTable(self.grammar)
+        fresh_ids = [0]
+        for parent, symbol in self.__access:
+            fresh_ids.append(fresh.__transitions[(fresh_ids[parent], symbol)])
+        return tuple(fresh.__item_sets[i] for i in fresh_ids)
+
+    def __setup_from_cache(self, gr, cached, symbols):
         self.terminals = gr.terminals + tuple([EOF_SYMBOL])
         self.nonterms = gr.nonterms[1:]
 
-        self.__ccol = tuple(get_canonical_collection(gr))
-        self.n_states = len(self.__ccol)
-
-        ccol_core = tuple(drop_itemset_lookaheads(x) for x in self.__ccol)
-        id_from_core = {ccol_core[i]: i for i in range(len(self.__ccol))}
+        self.n_states, action, goto, access = cached
+        self.__cached_rows = action, goto, symbols
+        if access is not None:
+            self.__access = tuple((parent, symbols[symbol]) for parent, symbol in access)
+            self.__ccol = None
+        else:
+            self.__ccol = (frozenset(),) * self.n_states
+
+    def __decode_cached_rows(self):
+        action, goto, symbols = self.__cached_rows
+        self.__cached_rows = None
+        decode = lambda code: self.ACTION_TYPES[code[0]](*code[1:])
+        self.__action = tuple({x: set() for x in self.terminals} for i in range(self.n_states))
+        for state_id, (row, cached_row) in enumerate(zip(self.__action, action)):
+            for t, e in cached_row:
+                row[symbols[t]].update(map(decode, e))
+                if len(e) == 0:
+                    self.__errors.add((state_id, symbols[t]))
+        self.__goto = tuple({x: None for x in self.nonterms} for i in range(self.n_states))
+        for row, cached_row in zip(self.__goto, goto):
+            for nt, sid in cached_row:
+                row[symbols[nt]] = sid
 
-        self.goto = tuple({x: None for x in self.nonterms} for i in range(self.n_states))
-        self.action = tuple({x: set() for x in self.terminals} for i in range(self.n_states))
+    def __setup_from_grammar(self, gr):
+        self.terminals = gr.terminals + tuple([EOF_SYMBOL])
+        self.nonterms = gr.nonterms[1:]
 
-        goto_precalc = tuple(dict() for i in range(self.n_states))
-        for symbol in (self.terminals + self.nonterms):
-            for state_id in range(self.n_states):
-                next_state = goto(gr, self.__ccol[state_id], symbol)
-                if len(next_state) == 0:
+        stats = gr.build_stats
+        # LALR(1) states share the cores and transitions of the LR(0) automaton
+        with stats.phase('grammar encoding'):
+            code = EncodedGrammar(gr)
+        with stats.phase('LR(0) automaton'):
+            dfa = LR0_Automaton(gr, code)
+        with stats.phase(f'lookaheads ({gr.lalr_method})'):
+            if gr.lalr_method == 'relations':
+                item_sets = get_lalr_collection(gr, dfa)
+            else:
+                item_sets = get_canonical_collection(gr, dfa)
+        # decoded into (item, terminal) pairs only when printed or cached
+        self.__encoded_ccol = code, item_sets
+        self.n_states = len(item_sets)
+        self.__transitions = dfa.goto
+        access = {}
+        for (state_id, symbol), next_state_id in dfa.goto.items():
+            access.setdefault(next_state_id, (state_id, symbol))
+        self.__access = tuple(access[state_id] for state_id in range(1, self.n_states))
+
+        with stats.phase('table filling'):
+            self.__fill_actions(gr, code, dfa, item_sets)
+        stats.count('states', self.n_states)
+        stats.count('LR(0) items', sum(map(len, dfa.item_sets)))
+        stats.count('kernel items', sum(map(len, dfa.kernel_item_sets())))
+        stats.count('item lookaheads', sum(bin(lookaheads).count('1') for item_set in item_sets
+                                           for lookaheads in item_set.values()))
+        stats.count('closure calls', code.closure_calls)
+
+    def __fill_actions(self, gr, code, dfa, item_sets):
+        self.__goto = tuple({x: None for x in self.nonterms} for i in range(self.n_states))
+        self.__action = tuple({x: set() for x in self.terminals} for i in range(self.n_states))
+
+        # transitions are taken only by items with lookaheads: in a grammar
+        # that is not reduced the others lead to states no input reaches
+        for state_id, item_set in enumerate(item_sets):
+            for item, lookaheads in item_set.items():
+                next_symbol = code.item_next[item]
+                if 0 <= next_symbol < code.n_nonterms:
+                    nt = code.symbols[next_symbol]
+                    self.goto[state_id][nt] = dfa.transitions[(state_id, next_symbol)]
+                elif next_symbol >= code.n_nonterms:
+                    terminal = code.symbols[next_symbol]
+                    next_state_id = dfa.transitions[(state_id, next_symbol)]
+                    self.action[state_id][terminal].add(Shift(next_state_id))
+                elif next_symbol < 0:
+                    prod_index = code.item_rule[item]
+                    for lookahead in code.decode_lookaheads(lookaheads):
+                        if prod_index == 0:
+                            assert (lookahead == EOF_SYMBOL)
+                            self.action[state_id][EOF_SYMBOL].add(Accept())
+                        else:
+                            self.action[state_id][lookahead].add(Reduce(prod_index))
+
+        self.__resolve_precedence(gr)
+
+    def __resolve_precedence(self, gr):
+        # yacc rules for shift/reduce conflicts between a rule and a terminal
+        # that both have a precedence: the higher level wins, on equal levels
+        # left reduces, right shifts and nonassoc leaves a syntax error
+        for state_id, row in enumerate(self.action):
+            for terminal, entries in row.items():
+                token_prec = gr.precedence.get(terminal)
+                if len(entries) <= 1 or token_prec is None:
                     continue
-                next_state_id = id_from_core[drop_itemset_lookaheads(next_state)]
-                goto_precalc[state_id][symbol] = next_state_id
-
-        for state_id in range(self.n_states):
-            for item, next_symbol in self.__ccol[state_id]:
-                prod_index, dot = item
-                pname, pbody, plambda = gr.productions[prod_index]
-
-                if dot < len(pbody):
-                    terminal = pbody[dot]
-                    if not isinstance(terminal, BaseTerminal) or terminal not in goto_precalc[state_id]:
+                for reduce in [e for e in entries if isinstance(e, Reduce)]:
+                    shift = next((e for e in entries if isinstance(e, Shift)), None)
+                    rule_prec = gr.rule_precedence[reduce.rule]
+                    if shift is None or rule_prec is None:
                         continue
-
-                    next_state_id = goto_precalc[state_id][terminal]
-                    self.action[state_id][terminal].add(Shift(next_state_id))
-                else:
-                    if prod_index == 0:
-                        assert (next_symbol == EOF_SYMBOL)
-                        self.action[state_id][EOF_SYMBOL].add(Accept())
+                    (rule_level, _), (token_level, assoc) = rule_prec, token_prec
+                    if rule_level > token_level or rule_level == token_level and assoc == 'left':
+                        entries.discard(shift)
+                    elif rule_level < token_level or assoc == 'right':
+                        entries.discard(reduce)
                     else:
-                        self.action[state_id][next_symbol].add(Reduce(prod_index))
-
-            for nt in self.nonterms:
-                if nt not in goto_precalc[state_id]:
-                    continue
-                next_state_id = goto_precalc[state_id][nt]
-                self.goto[state_id][nt] = next_state_id
+                        entries.discard(shift)
+                        entries.discard(reduce)
+                        self.errors.add((state_id, terminal))
 
     @staticmethod
     def __stringify_action_entries(term, ent):
@@ -319,7 +755,7 @@ class ParsingTable:
 
     def stringify_state(self, state_id):
         state_title = 'State %d\n' % state_id
-        items = drop_itemset_lookaheads(kernels(self.__ccol[state_id]))
+        items = drop_itemset_lookaheads(kernels(self.__item_sets[state_id]))
         items = sorted(items, key=lambda elem: elem[0])
         items_str = '\n'.join('\t' + self.__stringify_lr_zero_item(item) for item in items) + '\n\n'
         # TODO CHANGED FOR TERMINALS MAYBE WRONG
@@ -359,82 +795,362 @@ class ParsingTable:
         return (STATUS_OK if len(seq) == 0 else max(seq)) == STATUS_OK
 
 
-def get_canonical_collection(gr):
-    dfa = LR0_Automaton(gr)
-    kstates = dfa.kstates()
+class DenseTable:
+    # Runtime form of a ParsingTable: rows of ints indexed by terminal and
+    # nonterminal numbers. In actions 0 is an error, s + 1 shifts to state s
+    # and -(r + 1) reduces by rule r, so reducing by rule 0 (-1) accepts.
+    # Conflicting entries keep the action the parser used to pick, errors
+    # lists the %nonassoc error cells.
+    ERROR = 0
+    ACCEPT = -1
+
+    def __init__(self, table):
+        self.terminals = table.terminals
+        self.nonterms = table.nonterms
+        self.n_terminals = len(self.terminals)
+        self.n_nonterms = len(self.nonterms)
+        # symbols are matched by identity, cheaper than LiteralTerminal hashing
+        self.terminal_ids = {id(t): i for i, t in enumerate(self.terminals)}
+        nonterm_ids = {nt: i for i, nt in enumerate(self.nonterms)}
+
+        self.action = array.array('i', [self.ERROR]) * (table.n_states * self.n_terminals)
+        for state_id, row in enumerate(table.action):
+            for terminal_id, terminal in enumerate(self.terminals):
+                entries = row[terminal]
+                if len(entries) > 0:
+                    self.action[state_id * self.n_terminals + terminal_id] = \
+                        self.encode(next(iter(entries)))
+
+        self.goto = array.array('i', [-1]) * (table.n_states * self.n_nonterms)
+        for state_id, row in enumerate(table.goto):
+            for nonterm_id, nt in enumerate(self.nonterms):
+                if row[nt] is not None:
+                    self.goto[state_id * self.n_nonterms + nonterm_id] = row[nt]
+
+        productions = table.grammar.productions
+        self.rule_nonterm = array.array('i', (nonterm_ids.get(nt, -1) for nt, prod, fold
+                                              in productions))
+        self.rule_length = array.array('i', (len(prod) for nt, prod, fold in productions))
+        # A -> X with the default fold only renames the attribute of X
+        self.unit_rules = frozenset(rule for rule, (nt, prod, fold) in enumerate(productions)
+                                    if len(prod) == 1 and NonTerminal.is_default_fold(fold))
+
+    @staticmethod
+    def encode(action):
+        match action:
+            case Shift(state):
+                return state + 1
+            case Reduce(rule):
+                return -(rule + 1)
+            case Accept():
+                return DenseTable.ACCEPT
+
+
+class CompressedTable:
+    # yacc-style packing of a DenseTable. Each state gets a default action:
+    # its most frequent reduction, or an error. The default reduction is
+    # taken only on the lookaheads marked in default_lookaheads, those the
+    # dense row reduces by it: on any other a fold would run on input the
+    # table rejects. States whose only action is that reduction need no
+    # lookup at all (base -1). Other rows keep only the shifts and the other
+    # reductions; identical rows are merged and all of them are overlaid in
+    # one vector by row displacement, where check tells whose entry a slot
+    # holds. Goto columns are packed the same way per nonterminal, with the
+    # most frequent target as default. Built once, the arrays go to the table
+    # cache and generated modules.
+    ARRAYS = ('action_base', 'action_table', 'action_check', 'action_default',
+              'goto_base', 'goto_table', 'goto_check', 'goto_default',
+              'rule_nonterm', 'rule_length')
+
+    def __init__(self, dense=None, cached=None, symbols=None):
+        if cached is None:
+            self.__setup_from_dense(dense)
+        else:
+            self.__setup_from_cache(cached, symbols)
+
+    def to_cache(self, ids):
+        return tuple(ids[t] for t in self.terminals), self.n_symbols, \
+            tuple(tuple(getattr(self, name)) for name in self.ARRAYS), \
+            bytes(self.default_lookaheads), \
+            tuple((key, tuple(row)) for key, row in self.unit_chains.items())
+
+    def __setup_from_cache(self, cached, symbols):
+        # terminal numbers follow the order of the run that built the arrays
+        terminals, self.n_symbols, arrays, default_lookaheads, chains = cached
+        self.terminals = tuple(symbols[t] for t in terminals)
+        self.n_terminals = len(self.terminals)
+        self.terminal_ids = {id(t): i for i, t in enumerate(self.terminals)}
+        for name, values in zip(self.ARRAYS, arrays):
+            setattr(self, name, array.array('i', values))
+        self.default_lookaheads = default_lookaheads
+        self.unit_chains = {key: array.array('i', row) for key, row in chains}
+
+    def __setup_from_dense(self, dense):
+        n_states = len(dense.action) // dense.n_terminals
+        self.terminals = dense.terminals
+        self.n_terminals = dense.n_terminals
+        self.terminal_ids = dense.terminal_ids
+        self.rule_nonterm = dense.rule_nonterm
+        self.rule_length = dense.rule_length
+
+        self.action_default = array.array('i', [DenseTable.ERROR]) * n_states
+        self.default_lookaheads = bytearray(n_states * self.n_terminals)
+        rows = []
+        for state_id in range(n_states):
+            row = dense.action[state_id * self.n_terminals:(state_id + 1) * self.n_terminals]
+            reductions = collections.Counter(code for code in row if code < DenseTable.ACCEPT)
+            if len(reductions) > 0:
+                self.action_default[state_id] = reductions.most_common(1)[0][0]
+            default = self.action_default[state_id]
+            for terminal_id, code in enumerate(row):
+                if code == default and code != DenseTable.ERROR:
+                    self.default_lookaheads[state_id * self.n_terminals + terminal_id] = 1
+            rows.append([(terminal_id, code) for terminal_id, code in enumerate(row)
+                         if code != default and code != DenseTable.ERROR])
+        self.action_base, self.action_table, self.action_check = \
+            self.pack(rows, self.n_terminals)
+
+        n_nonterms = len(dense.goto) // n_states if n_states > 0 else 0
+        self.goto_default = array.array('i', [-1]) * n_nonterms
+        columns = []
+        for nonterm_id in range(n_nonterms):
+            column = [(state_id, dense.goto[state_id * n_nonterms + nonterm_id])
+                      for state_id in range(n_states)]
+            targets = collections.Counter(target for state_id, target in column if target >= 0)
+            if len(targets) > 0:
+                self.goto_default[nonterm_id] = targets.most_common(1)[0][0]
+            columns.append([(state_id, target) for state_id, target in column
+                            if target >= 0 and target != self.goto_default[nonterm_id]])
+        self.goto_base, self.goto_table, self.goto_check = self.pack(columns, n_states)
+
+        self.n_symbols = self.n_terminals + n_nonterms
+        self.unit_chains = self.unit_chains_of(dense, n_states, n_nonterms)
+
+    @staticmethod
+    def unit_chains_of(dense, n_states, n_nonterms):
+        # Entering state q from s on symbol X, the parser may go on reducing
+        # A -> X, B -> A... by unit rules with the default fold, which leave
+        # the stack as it was except for the state on top. For every s and X
+        # (terminals first, then nonterminals) such a chain is resolved
+        # beforehand into the final state per lookahead, -1 where there is
+        # none. Only explicit table entries are followed: a reduction by
+        # default in an error case has to stay on record for error reports.
+        n_terminals = dense.n_terminals
+        # lookaheads on which each state reduces by such a unit rule: a
+        # chain can only start in a state that has some
+        unit_lookaheads = []
+        for state_id in range(n_states):
+            row = dense.action[state_id * n_terminals:(state_id + 1) * n_terminals]
+            unit_lookaheads.append([terminal_id for terminal_id, code in enumerate(row)
+                                    if code < DenseTable.ACCEPT
+                                    and -code - 1 in dense.unit_rules])
+
+        chains = {}
+        for state_id in range(n_states):
+            targets = []
+            for terminal_id in range(n_terminals):
+                code = dense.action[state_id * n_terminals + terminal_id]
+                targets.append(code - 1 if code > 0 else -1)
+            targets.extend(dense.goto[state_id * n_nonterms:(state_id + 1) * n_nonterms])
+
+            for symbol_id, target in enumerate(targets):
+                if target < 0 or len(unit_lookaheads[target]) == 0:
+                    continue
+                row = array.array('i', [-1]) * n_terminals
+                for terminal_id in unit_lookaheads[target]:
+                    seen = {target}
+                    final = target
+                    while True:
+                        code = dense.action[final * n_terminals + terminal_id]
+                        if code >= DenseTable.ACCEPT or -code - 1 not in dense.unit_rules:
+                            break
+                        nonterm_id = dense.rule_nonterm[-code - 1]
+                        final = dense.goto[state_id * n_nonterms + nonterm_id]
+                        if final in seen:
+                            final = target
+                            break
+                        seen.add(final)
+                    if final != target:
+                        row[terminal_id] = final
+                if any(final >= 0 for final in row):
+                    chains[state_id * (n_terminals + n_nonterms) + symbol_id] = row
+        return chains
+
+    @staticmethod
+    def pack(rows, width):
+        bases = array.array('i', [-1]) * len(rows)
+        table, check = array.array('i'), array.array('i')
+        placed = {}
+        used_bases = set()
+        for row_id in sorted(range(len(rows)), key=lambda row_id: -len(rows[row_id])):
+            row = tuple(rows[row_id])
+            if len(row) == 0:
+                continue
+            if row in placed:
+                bases[row_id] = placed[row]
+                continue
+
+            base = 0
+            while base in used_bases \
+                    or any(base + col < len(check) and check[base + col] != -1 for col, value in row):
+                base += 1
+            if len(check) < base + width:
+                table.extend([0] * (base + width - len(check)))
+                check.extend([-1] * (base + width - len(check)))
+            for col, value in row:
+                table[base + col] = value
+                check[base + col] = base
+            used_bases.add(base)
+            placed[row] = bases[row_id] = base
+        return bases, table, check
+
+
+def get_canonical_collection(gr, dfa=None):
+    dfa = dfa or LR0_Automaton(gr)
+    code = dfa.code
+    kstates = dfa.kernel_item_sets()
     n_states = len(kstates)
 
     table = [{item: LrZeroItemTableEntry() for item in kstates[i]} for i in range(n_states)]
-    table[0][(0, 0)].lookaheads.add(EOF_SYMBOL)
+    table[0][0].lookaheads = code.eof
 
     for i_state_id in range(n_states):
-        state_symbols = [x[1] for x, y in dfa.goto.items() if x[0] == i_state_id]
-
         for i_item in kstates[i_state_id]:
-            closure_set = closure(gr, [(i_item, FREE_SYMBOL)])
+            closure_set = code.closure_lookaheads({i_item: code.free})
 
-            for sym in state_symbols:
-                j_state_id = dfa.goto[(i_state_id, sym)]
+            # For each item in closure_set whose . (dot) points to some symbol,
+            # its lookaheads go to the item with the dot moved in the successor
+            for item, next_symbols in closure_set.items():
+                sym = code.item_next[item]
+                if sym < 0:
+                    continue
 
-                # For each item in closure_set whose . (dot) points to a symbol equal to 'sym'
-                # i.e. a production expecting to see 'sym' next
-                for ((prod_index, dot), next_symbol) in closure_set:
-                    pname, pbody, plambda = gr.productions[prod_index]
-                    if dot == len(pbody) or pbody[dot] != sym:
-                        continue
-
-                    j_item = (prod_index, dot + 1)
-                    if next_symbol == FREE_SYMBOL:
-                        table[i_state_id][i_item].propagates_to.add((j_state_id, j_item))
-                    else:
-                        table[j_state_id][j_item].lookaheads.add(next_symbol)
+                j_state_id = dfa.transitions[(i_state_id, sym)]
+                j_item = item + 1
+                if next_symbols & code.free:
+                    table[i_state_id][i_item].propagates_to.add((j_state_id, j_item))
+                table[j_state_id][j_item].lookaheads |= next_symbols & ~code.free
 
     repeat = True
     while repeat:
         repeat = False
+        gr.build_stats.count('propagation passes', 1)
         for i_state_id in range(len(table)):
             for i_item, i_cell in table[i_state_id].items():
                 # For every kernel item i_item's lookaheads propagate to
                 for j_state_id, j_item in i_cell.propagates_to:
                     j_cell = table[j_state_id][j_item]
-                    j_cell_lookaheads_len = len(j_cell.lookaheads)
-                    j_cell.lookaheads.update(i_cell.lookaheads)
-                    if j_cell_lookaheads_len < len(j_cell.lookaheads):
+                    j_cell_lookaheads = j_cell.lookaheads | i_cell.lookaheads
+                    if j_cell_lookaheads != j_cell.lookaheads:
+                        j_cell.lookaheads = j_cell_lookaheads
                         repeat = True
 
-    result = [set() for i in range(n_states)]
-    for i_state_id in range(n_states):
-        for i_item, i_cell in table[i_state_id].items():
-            for sym in i_cell.lookaheads:
-                item_set = (i_item, sym)
-                result[i_state_id].add(item_set)
-        result[i_state_id] = closure(gr, result[i_state_id])
+    return [code.closure_lookaheads({i_item: i_cell.lookaheads
+                                     for i_item, i_cell in table[i_state_id].items()
+                                     if i_cell.lookaheads != 0})
+            for i_state_id in range(n_states)]
+
+
+def get_lalr_collection(gr, dfa=None):
+    # LALR(1) lookaheads by DeRemer and Pennello: Follow sets of nonterminal
+    # transitions of the LR(0) automaton are computed from the reads and
+    # includes relations, then spread to the items of each rule along the
+    # path the rule spells from the transition's source (lookback).
+    dfa = dfa or LR0_Automaton(gr)
+    code = dfa.code
+    # The relations hold for reduced grammars: with a nonterminal that
+    # derives nothing they pass on lookaheads no parse can need and make
+    # conflicts out of them. Propagation has no such premise.
+    if not all(code.productive):
+        gr.build_stats.count('non-productive nonterminals', code.productive.count(False))
+        return get_canonical_collection(gr, dfa)
+    accept = code.symbol_ids[gr.productions[0][0]]
+
+    outgoing = collections.defaultdict(list)
+    for state_id, symbol in dfa.transitions:
+        outgoing[state_id].append(symbol)
+
+    transitions = [(0, accept)] + [(state_id, symbol) for state_id, symbol in dfa.transitions
+                                   if symbol < code.n_nonterms]
+    direct_reads = {(0, accept): code.eof}
+    reads = {(0, accept): []}
+    for state_id, nt in transitions[1:]:
+        target = dfa.transitions[(state_id, nt)]
+        direct_reads[(state_id, nt)] = code.terminal_mask(symbol for symbol in outgoing[target]
+                                                          if symbol >= code.n_nonterms)
+        reads[(state_id, nt)] = [(target, symbol) for symbol in outgoing[target]
+                                 if symbol < code.n_nonterms and code.nullable[symbol]]
+
+    includes = {transition: [] for transition in transitions}
+    lookback = collections.defaultdict(list)
+    for transition in transitions:
+        source, nt = transition
+        for item in code.nt_rules[nt]:
+            state_id = source
+            while code.item_next[item] >= 0:
+                symbol = code.item_next[item]
+                lookback[(state_id, item)].append(transition)
+                if symbol < code.n_nonterms and code.item_nullable[item + 1]:
+                    includes[(state_id, symbol)].append(transition)
+                state_id = dfa.transitions[(state_id, symbol)]
+                item += 1
+            lookback[(state_id, item)].append(transition)
+
+    gr.build_stats.count('nonterminal transitions', len(transitions))
+    gr.build_stats.count('includes edges', sum(map(len, includes.values())))
+    read_sets = digraph(transitions, reads, direct_reads)
+    follow_sets = digraph(transitions, includes, read_sets)
+
+    result = [dict() for i in range(len(dfa.item_sets))]
+    for (state_id, item), sources in lookback.items():
+        lookaheads = 0
+        for transition in sources:
+            lookaheads |= follow_sets[transition]
+        if lookaheads != 0:
+            result[state_id][item] = lookaheads
 
     return result
 
 
-def closure(gr, item_set):
-    result = set(item_set)
-    current = item_set
+def digraph(nodes, relation, initial):
+    # F(x) = initial(x) | U{F(y) : x relation y}, one pass with SCC collapsing;
+    # the sets are bitmasks
+    result = {x: initial[x] for x in nodes}
+    depth = dict.fromkeys(nodes, 0)
+    finished = len(nodes) + 1
+    stack = []
 
-    while len(current) > 0:
-        new_elements = []
-        for ((prod_index, dot), lookahead) in current:
-            pname, pbody, plambda = gr.productions[prod_index]
-            if dot == len(pbody) or pbody[dot] not in gr.nonterms:
-                continue
-            nt = pbody[dot]
-            nt_offset = gr.nonterm_offset[nt]
-            following_symbols = pbody[dot + 1:] + [lookahead]
-            following_terminals = gr.first_set(following_symbols) - {None}
-            for idx in range(len(nt.productions)):
-                for term in following_terminals:
-                    new_item_set = ((nt_offset + idx, 0), term)
-                    if new_item_set not in result:
-                        result.add(new_item_set)
-                        new_elements += [new_item_set]
-        current = new_elements
-    return frozenset(result)
+    for root in nodes:
+        if depth[root] != 0:
+            continue
+        stack.append(root)
+        depth[root] = len(stack)
+        work = [(root, len(stack), iter(relation[root]))]
+        while len(work) > 0:
+            x, index, successors = work[-1]
+            for y in successors:
+                if depth[y] == 0:
+                    stack.append(y)
+                    depth[y] = len(stack)
+                    work.append((y, len(stack), iter(relation[y])))
+                    break
+                depth[x] = min(depth[x], depth[y])
+                result[x] |= result[y]
+            else:
+                work.pop()
+                if depth[x] == index:
+                    while True:
+                        y = stack.pop()
+                        depth[y] = finished
+                        result[y] = result[x]
+                        if y == x:
+                            break
+                if len(work) > 0:
+                    parent = work[-1][0]
+                    depth[parent] = min(depth[parent], depth[x])
+                    result[parent] |= result[x]
+
+    return result
 
 
 class Error(Exception, abc.ABC):
@@ -457,7 +1173,54 @@ class ParseError(Error):
 
 
 class Parser(object):
-    def __init__(self, start_nonterminal):
+    LEXER_ENGINES = ('regex', 'dfa')
+    LALR_METHODS = ('relations', 'propagation')
+    ASSOCIATIVITIES = ('left', 'right', 'nonassoc')
+    CACHE_VERSION = 6
+
+    # lexer_engine='dfa' scans once with an automaton of all the terminals;
+    # matches where it and re may differ are rechecked with re
+    def __init__(self, start_nonterminal, *, lexer_engine='regex', cache_dir=None,
+                 lalr_method='relations', precedence=(), trace_memory=False):
+        self.__setup_grammar(start_nonterminal, precedence)
+        self.build_stats = BuildStats(trace_memory)
+        self.__first_sets = {}
+        self.__suffix_first_sets = {}
+        self.skipped_domains = []
+
+        if lexer_engine not in self.LEXER_ENGINES:
+            raise ValueError('Unknown lexer engine', lexer_engine)
+        self.lexer_engine = lexer_engine
+        self.__lexer_spec = LexerSpec(self.terminals, self.skipped_domains)
+
+        if lalr_method not in self.LALR_METHODS:
+            raise ValueError('Unknown LALR lookahead method', lalr_method)
+        self.lalr_method = lalr_method
+
+        cache_path = fingerprint = None
+        if cache_dir is not None:
+            fingerprint = self.fingerprint()
+            # one file per start symbol: storing a new one prunes the stale
+            cache_prefix = 'lalr-' + re.sub(r'\W', '_', start_nonterminal.name) + '-'
+            cache_path = os.path.join(cache_dir, f'{cache_prefix}{fingerprint}.marshal')
+
+        started_tracing = trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        try:
+            self.__build_tables(cache_path, fingerprint)
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+
+    @classmethod
+    def grammar_fingerprint(cls, start_nonterminal, precedence=()):
+        # fingerprint() of the parser for the grammar, without its tables
+        self = cls.__new__(cls)
+        self.__setup_grammar(start_nonterminal, precedence)
+        return self.fingerprint()
+
+    def __setup_grammar(self, start_nonterminal, precedence):
         fake_axiom = NonTerminal(START_SYMBOL)
         fake_axiom |= start_nonterminal
 
@@ -466,7 +1229,8 @@ class Parser(object):
         self.symbols = ()
         self.productions = []
         self.nonterm_offset = {}
-        self.__first_sets = {}
+        self.precedence = {}
+        self.rule_precedence = []
 
         def register(symbol):
             if isinstance(symbol, BaseTerminal):
@@ -495,13 +1259,358 @@ class Parser(object):
 
             scanned_count = last_unscanned
 
+        # levels grow from the first declaration to the last, as in yacc
+        for level, (assoc, *symbols) in enumerate(precedence, 1):
+            if assoc not in self.ASSOCIATIVITIES:
+                raise ValueError('Unknown associativity', assoc)
+            for symbol in symbols:
+                symbol = LiteralTerminal(symbol) if isinstance(symbol, str) else symbol
+                if symbol in self.precedence:
+                    raise ValueError('Precedence declared twice', symbol)
+                self.precedence[symbol] = level, assoc
+
+        # a rule takes the precedence of its %prec symbol or its last terminal
+        for nt, prod, func in self.productions:
+            prec = nt.precs[len(self.rule_precedence) - self.nonterm_offset[nt]]
+            if prec is None:
+                prec = next((symbol for symbol in reversed(prod)
+                             if isinstance(symbol, BaseTerminal)), None)
+            elif prec not in self.precedence:
+                raise ValueError('Undeclared precedence symbol', prec)
+            self.rule_precedence.append(self.precedence.get(prec))
+
         self.terminals = tuple(sorted(self.terminals, key=id))
         self.nonterms = tuple(sorted(self.nonterms, key=lambda nt: nt.name))
         self.symbols = self.nonterms + self.terminals
-        self.skipped_domains = []
 
-        self.__build_first_sets()
-        self.table = ParsingTable(self)
+    def __build_tables(self, cache_path, fingerprint):
+        stats = self.build_stats
+        loaded = False
+        if cache_path is not None:
+            with stats.phase('cache load'):
+                loaded = self.__load_tables(cache_path, fingerprint)
+        if not loaded:
+            with stats.phase('first sets'):
+                self.__build_first_sets()
+            self.table = ParsingTable(self)
+            with stats.phase('runtime tables'):
+                self.__compressed = CompressedTable(DenseTable(self.table))
+            if cache_path is not None:
+                with stats.phase('cache store'):
+                    self.__store_tables(cache_path, fingerprint)
+        with stats.phase('reducers'):
+            self.__terminal_ids = {t: i for i, t in enumerate(self.table.terminals)}
+            self.__reducers = [self.__make_reducer(prod, fold)
+                               for nt, prod, fold in self.productions]
+        stats.count('rules', len(self.productions))
+        stats.count('terminals', len(self.terminals))
+        stats.count('nonterminals', len(self.nonterms))
+        stats.count('packed action entries', len(self.__compressed.action_table))
+        stats.count('packed goto entries', len(self.__compressed.goto_table))
+
+    @classmethod
+    def from_tables(cls, nonterm_names, terminals, productions, folds, action, goto,
+                    skipped_domains=(), runtime=None, *, lexer_engine='regex'):
+        self = cls.__new__(cls)
+        self.nonterms = tuple(map(NonTerminal, nonterm_names))
+        self.terminals = tuple(terminals)
+        self.symbols = self.nonterms + self.terminals
+        self.productions = []
+        self.nonterm_offset = {}
+        self.precedence = {}
+        self.rule_precedence = []
+        self.build_stats = BuildStats()
+        self.__first_sets = {}
+        self.__suffix_first_sets = {}
+        self.skipped_domains = list(skipped_domains)
+        self.lalr_method = None
+
+        if lexer_engine not in self.LEXER_ENGINES:
+            raise ValueError('Unknown lexer engine', lexer_engine)
+        self.lexer_engine = lexer_engine
+        self.__lexer_spec = LexerSpec(self.terminals, self.skipped_domains)
+
+        symbols = self.symbols + tuple([EOF_SYMBOL])
+        for (nt, prod), fold in zip(productions, folds):
+            nt, prod = symbols[nt], [symbols[symbol] for symbol in prod]
+            self.nonterm_offset.setdefault(nt, len(self.productions))
+            nt.productions.append(prod)
+            nt.lambdas.append(fold)
+            nt.precs.append(None)
+            self.productions.append((nt, prod, fold))
+            self.rule_precedence.append(None)
+
+        n_states = len(action)
+        self.table = ParsingTable(self, (n_states, action, goto, None), symbols)
+        self.__terminal_ids = {t: i for i, t in enumerate(self.table.terminals)}
+        if runtime is not None:
+            self.__compressed = CompressedTable(cached=runtime, symbols=symbols)
+        else:
+            self.__compressed = CompressedTable(DenseTable(self.table))
+        self.__reducers = [self.__make_reducer(prod, fold) for nt, prod, fold in self.productions]
+        return self
+
+    @staticmethod
+    def __make_reducer(prod, fold):
+        # A reducer pops the rule's body off the stack and returns the
+        # coordinates and the attribute of the result. Terminals without an
+        # attribute function never carry an attribute, and a simple fold
+        # needs no Fragments, so the common shapes get their own closures.
+        # Without lines the parse tracks no positions: extended folds get
+        # None in place of every coordinate.
+        if fold is None:
+            return None
+
+        n = len(prod)
+        positions = [i - n for i, symbol in enumerate(prod)
+                     if not (isinstance(symbol, BaseTerminal) and symbol.func is None)]
+        simple = fold.simple
+
+        if n == 0:
+            def reducer(stack, lines, start):
+                if simple is not None:
+                    return start, start, simple()
+                if lines is None:
+                    return start, start, fold.callee([], [], None)
+                return start, start, fold.callee([], [], Fragment(lines, start, start))
+        elif simple is not None and len(positions) == 0:
+            def reducer(stack, lines, start):
+                begin, end = stack[-n][1], stack[-1][2]
+                del stack[-n:]
+                return begin, end, simple()
+        elif simple is not None and len(positions) == 1:
+            i, = positions
+
+            def reducer(stack, lines, start):
+                begin, end, attr = stack[-n][1], stack[-1][2], stack[i][3]
+                del stack[-n:]
+                return begin, end, simple(attr) if attr is not None else simple()
+        elif simple is not None and len(positions) == 2:
+            i, j = positions
+
+            def reducer(stack, lines, start):
+                begin, end, attr1, attr2 = stack[-n][1], stack[-1][2], stack[i][3], stack[j][3]
+                del stack[-n:]
+                if attr1 is not None and attr2 is not None:
+                    return begin, end, simple(attr1, attr2)
+                return begin, end, simple(*[a for a in (attr1, attr2) if a is not None])
+        elif simple is not None:
+            def reducer(stack, lines, start):
+                begin, end = stack[-n][1], stack[-1][2]
+                attrs = [attr for attr in [stack[i][3] for i in positions] if attr is not None]
+                del stack[-n:]
+                return begin, end, simple(*attrs)
+        else:
+            def reducer(stack, lines, start):
+                entries = stack[-n:]
+                del stack[-n:]
+                attrs = [attr for attr in [entries[i][3] for i in positions] if attr is not None]
+                begin, end = entries[0][1], entries[-1][2]
+                if lines is None:
+                    return begin, end, fold.callee(attrs, [None] * n, None)
+                coords = [Fragment(lines, begin, end) for state, begin, end, attr in entries]
+                return begin, end, fold.callee(attrs, coords, Fragment(lines, begin, end))
+
+        return reducer
+
+    def generate(self, grammar, file=sys.stdout):
+        symbols = self.__cache_symbols()
+        ids = {symbol: i for i, symbol in enumerate(symbols)}
+        n_states, action, goto, access = self.table.to_cache(symbols)
+        runtime_terminals, n_symbols, arrays, default_lookaheads, chains = \
+            self.__compressed.to_cache(ids)
+        names = {id(value): name for name, value in vars(grammar).items()
+                 if isinstance(value, Symbol)}
+
+        def func_reference(terminal):
+            func = terminal.func
+            qualname = getattr(func, '__qualname__', None)
+            if func is None:
+                return 'None'
+            elif getattr(func, '__module__', None) == 'builtins':
+                return qualname
+            elif qualname is not None and getattr(grammar, qualname, None) is func:
+                return f'grammar.{qualname}'
+            elif id(terminal) in names:
+                return f'grammar.{names[id(terminal)]}.func'
+            raise ValueError('Cannot reference the attribute function', terminal)
+
+        def terminal_source(terminal):
+            match terminal:
+                case Terminal():
+                    return f'pe.Terminal({terminal.name!r}, {terminal.regex!r}, ' \
+                        + f'{func_reference(terminal)}, priority={terminal.priority!r}, ' \
+                        + f're_flags={terminal.re.flags!r})'
+                case LiteralTerminal():
+                    return f'pe.LiteralTerminal({terminal.image!r})'
+                case _:
+                    raise ValueError('Unsupported terminal', terminal)
+
+        def fold_reference(nt, index):
+            if nt.name == START_SYMBOL:
+                return 'None'
+            elif id(nt) not in names:
+                raise ValueError('Cannot reference the folds of', nt)
+            return f'grammar.{names[id(nt)]}.lambdas[{index}]'
+
+        def rows(table):
+            return ''.join(f'    {row!r},\n' for row in table)
+
+        def symbol_reference(symbol):
+            if isinstance(symbol, LiteralTerminal):
+                return repr(symbol.image)
+            elif id(symbol) not in names:
+                raise ValueError('Cannot reference the symbol', symbol)
+            return f'grammar.{names[id(symbol)]}'
+
+        # the declarations again, level by level, for the fingerprint check
+        levels = [['left'] for level in range(max((level for level, assoc
+                                                    in self.precedence.values()), default=0))]
+        for symbol, (level, assoc) in self.precedence.items():
+            levels[level - 1][0] = repr(assoc)
+            if symbol in ids:
+                levels[level - 1].append(symbol_reference(symbol))
+        start = self.productions[0][1][0]
+
+        folds = [fold_reference(nt, i - self.nonterm_offset[nt])
+                 for i, (nt, prod, fold) in enumerate(self.productions)]
+        productions = [(ids[nt], tuple(ids[symbol] for symbol in prod))
+                       for nt, prod, fold in self.productions]
+        terminals = [symbol for symbol in symbols if isinstance(symbol, BaseTerminal)]
+
+        print(f'# Generated by parser_edsl from module {grammar.__name__!r}, do not edit.',
+              'import parser_edsl as pe',
+              '',
+              '',
+              f'FINGERPRINT = {self.fingerprint()!r}',
+              '',
+              f'NONTERMINALS = {tuple(nt.name for nt in self.nonterms)!r}',
+              '',
+              f'SKIPPED_DOMAINS = {tuple(self.skipped_domains)!r}',
+              '',
+              f'PRODUCTIONS = (\n{rows(productions)})',
+              '',
+              f'ACTION = (\n{rows(action)})',
+              '',
+              f'GOTO = (\n{rows(goto)})',
+              '',
+              'RUNTIME = (',
+              f'    {runtime_terminals!r},',
+              f'    {n_symbols!r},',
+              '    (\n' + ''.join(f'        {row!r},\n' for row in arrays) + '    ),',
+              f'    {default_lookaheads!r},',
+              '    (\n' + ''.join(f'        {row!r},\n' for row in chains) + '    ),',
+              ')',
+              '',
+              '',
+              'def load(grammar, **kwargs):',
+              '    # folds are taken by position: a grammar changed since the',
+              '    # tables were generated would get the actions of other rules',
+              '    precedence = (',
+              ''.join(f'        ({", ".join(level)}{"," if len(level) == 1 else ""}),\n'
+                      for level in levels) + '    )',
+              f'    start = {symbol_reference(start)}',
+              '    if pe.Parser.grammar_fingerprint(start, precedence) != FINGERPRINT:',
+              '        raise ValueError(\'The grammar has changed since the tables were generated\',',
+              '                         grammar.__name__)',
+              '    terminals = (',
+              ''.join(f'        {terminal_source(t)},\n' for t in terminals[:-1]) + '    )',
+              '    folds = (',
+              ''.join(f'        {fold},\n' for fold in folds) + '    )',
+              '    return pe.Parser.from_tables(NONTERMINALS, terminals, PRODUCTIONS, folds,',
+              '                                 ACTION, GOTO, SKIPPED_DOMAINS, RUNTIME, **kwargs)',
+              sep='\n', file=file)
+
+    def __cache_symbols(self):
+        # terminals are ordered by id() in self.terminals, which differs from
+        # run to run, so the cache numbers them by first use in the rules
+        terminals = {}
+        for nt, prod, func in self.productions:
+            for symbol in prod:
+                if isinstance(symbol, BaseTerminal):
+                    terminals.setdefault(symbol)
+        return self.nonterms + tuple(terminals) + tuple([EOF_SYMBOL])
+
+    def fingerprint(self):
+        symbols = self.__cache_symbols()
+        ids = {symbol: i for i, symbol in enumerate(symbols)}
+
+        def describe_func(func):
+            if isinstance(func, ExAction):
+                func = func.simple if func.simple is not None else func.callee
+            if func is None:
+                return None
+            return getattr(func, '__module__', None), \
+                getattr(func, '__qualname__', type(func).__qualname__)
+
+        def describe_symbol(symbol):
+            match symbol:
+                case NonTerminal():
+                    return 'NonTerminal', symbol.name
+                case Terminal():
+                    return 'Terminal', symbol.name, symbol.regex, symbol.priority, \
+                        symbol.re.flags, describe_func(symbol.func)
+                case LiteralTerminal():
+                    return 'LiteralTerminal', symbol.image
+                case _:
+                    return type(symbol).__name__, symbol.name
+
+        grammar = (
+            self.CACHE_VERSION,
+            tuple(map(describe_symbol, symbols)),
+            tuple((ids[nt], tuple(ids[symbol] for symbol in prod), describe_func(func), prec)
+                  for (nt, prod, func), prec in zip(self.productions, self.rule_precedence)),
+            tuple(sorted((ids[t], prec) for t, prec in self.precedence.items() if t in ids)),
+        )
+        return hashlib.sha256(repr(grammar).encode('utf-8')).hexdigest()
+
+    def __load_tables(self, path, fingerprint):
+        symbols = self.__cache_symbols()
+        try:
+            with open(path, 'rb') as f:
+                # loads() on the whole file, load() reads it in small pieces
+                cached_fingerprint, first_sets, table, runtime = marshal.loads(f.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            return False
+        if cached_fingerprint != fingerprint:
+            return False
+
+        self.__first_sets = {symbols[nt]: frozenset(symbols[t] if t is not None else None
+                                                    for t in first)
+                             for nt, first in first_sets}
+        self.table = ParsingTable(self, table, symbols)
+        self.__compressed = CompressedTable(cached=runtime, symbols=symbols)
+        return True
+
+    def __store_tables(self, path, fingerprint):
+        symbols = self.__cache_symbols()
+        ids = {symbol: i for i, symbol in enumerate(symbols)}
+        first_sets = tuple((ids[nt], frozenset(ids[t] if t is not None else None for t in first))
+                           for nt, first in self.__first_sets.items())
+        data = fingerprint, first_sets, self.table.to_cache(symbols), \
+            self.__compressed.to_cache(ids)
+
+        # the cache is an optimization only, a failed write must not break parsing
+        try:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                marshal.dump(data, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+
+        # older files of this start symbol, and those named by the
+        # fingerprint alone before version 4
+        directory, name = os.path.split(path)
+        prefix = name[:-len(f'{fingerprint}.marshal')]
+        for stale in os.listdir(directory or '.'):
+            if stale != name and (stale.startswith(prefix) and stale.endswith('.marshal')
+                                  or re.fullmatch(r'lalr-[0-9a-f]{64}\.marshal', stale)):
+                try:
+                    os.remove(os.path.join(directory, stale))
+                except OSError:
+                    pass
 
     def first_set(self, x):
         result = set()
@@ -517,6 +1626,13 @@ class Parser(object):
             result.add(None)
         return frozenset(result)
 
+    def suffix_first_set(self, prod_index, dot):
+        key = prod_index, dot
+        if key not in self.__suffix_first_sets:
+            pname, pbody, plambda = self.productions[prod_index]
+            self.__suffix_first_sets[key] = self.first_set(pbody[dot:])
+        return self.__suffix_first_sets[key]
+
     def __build_first_sets(self):
         for s in self.nonterms:
             self.__first_sets[s] = set()
@@ -549,71 +1665,190 @@ class Parser(object):
 
     def add_skipped_domain(self, regex):
         self.skipped_domains.append(regex)
+        self.__lexer_spec = LexerSpec(self.terminals, self.skipped_domains)
+
+    def __make_lexer(self, text, chunks=None, errors=None):
+        spec = self.__lexer_spec
+        return Lexer(spec, text, spec.dfa if self.lexer_engine == 'dfa' else None, chunks,
+                     errors)
+
+    @contextlib.contextmanager
+    def __file_lexer(self, path, encoding, errors=None):
+        with open(path, 'rb') as f:
+            if self.__lexer_spec.binary and os.fstat(f.fileno()).st_size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if NON_BINARY_BYTES.search(mm) is None:
+                        lexer = self.__make_lexer(mm, errors=errors)
+                        try:
+                            yield lexer
+                        finally:
+                            # fragments may outlive the mapping
+                            lexer.lines.build()
+                        return
+            yield self.__make_lexer('', read_text_chunks(f, encoding), errors)
+
+    # on_reduce[nt](attr, coord) runs once nt is reduced, its result replaces
+    # attr for the enclosing fold, None drops the attribute
+    def parse(self, text, track_positions=True, on_reduce=None):
+        return self.__parse(self.__make_lexer(text), track_positions, on_reduce)
+
+    def parse_file(self, path, encoding='utf-8', track_positions=True, on_reduce=None):
+        with self.__file_lexer(path, encoding) as lexer:
+            return self.__parse(lexer, track_positions, on_reduce)
+
+    def parse_stream(self, fileobj, encoding='utf-8', track_positions=True, on_reduce=None):
+        return self.__parse(self.__make_lexer('', read_text_chunks(fileobj, encoding)),
+                            track_positions, on_reduce)
 
-    def parse(self, text):
-        lexer = Lexer(self.terminals, text, self.skipped_domains)
-        stack = [(0, Fragment(Position(), Position()), None)]
-        cur = lexer.next_token()
+    @staticmethod
+    def __observe(reducer, callback):
+        def observed(stack, lines, start):
+            begin, end, attr = reducer(stack, lines, start)
+            coord = Fragment(lines, begin, end) if lines is not None else None
+            return begin, end, callback(attr, coord)
+
+        return observed
+
+    def __observed_reducers(self, on_reduce):
+        # see parse() for the contract. A unit chain would skip the
+        # reductions to its nonterminals, so such parses go without.
+        heads = {nt for nt, prod, fold in self.productions}
+        for nt in on_reduce:
+            if nt not in heads:
+                raise ValueError('Not a nonterminal of the grammar', nt)
+        reducers = [self.__observe(reducer, on_reduce[nt]) if nt in on_reduce else reducer
+                    for (nt, prod, fold), reducer in zip(self.productions, self.__reducers)]
+        chained = any(nt in on_reduce and len(prod) == 1 and NonTerminal.is_default_fold(fold)
+                      for nt, prod, fold in self.productions)
+        return reducers, chained
+
+    def __parse(self, lexer, track_positions=True, on_reduce=None):
+        lines = lexer.lines
+        # the line index is consulted only for an error then
+        fold_lines = lines if track_positions else None
+        table = self.__compressed
+        action_base, action_table, action_check, action_default = \
+            table.action_base, table.action_table, table.action_check, table.action_default
+        goto_base, goto_table, goto_check, goto_default = \
+            table.goto_base, table.goto_table, table.goto_check, table.goto_default
+        terminal_ids = table.terminal_ids
+        rule_nonterm = table.rule_nonterm
+        unit_chains, n_terminals, n_symbols = table.unit_chains, table.n_terminals, table.n_symbols
+        reducers = self.__reducers
+        if on_reduce:
+            reducers, chained = self.__observed_reducers(on_reduce)
+            if chained:
+                unit_chains = {}
+        default_lookaheads = table.default_lookaheads
+
+        def next_match():
+            match = lexer.next_match()
+            if match is None:
+                end = lexer.base + lexer.offset
+                match = EOF_SYMBOL, end, end, None
+            return match
+
+        stack = [(0, 0, 0, None)]
+        domain, cur_start, cur_end, lexeme = next_match()
+        cur_id = terminal_ids[id(domain)]
         while True:
-            cur_state, cur_coord, top_attr = stack[-1]
-            action = next(iter(self.table.action[cur_state][cur.type]), None)
-            match action:
-                case Shift(state):
-                    stack.append((state, cur.pos, cur.attr))
-                    cur = lexer.next_token()
-                case Reduce(rule):
-                    nt, prod, fold = self.productions[rule]
-                    n = len(prod)
-                    attrs = [attr for state, coord, attr in stack[len(stack)-n:]
-                             if attr != None]
-                    coords = [coord for state, coord, attr in stack[len(stack)-n:]]
-                    if len(coords) > 0:
-                        res_coord = Fragment(coords[0].start, coords[-1].following)
-                    else:
-                        res_coord = Fragment(cur.pos.start, cur.pos.start)
-                    del stack[len(stack)-n:]
-                    goto_state = self.table.goto[stack[-1][0]][nt]
-                    res_attr = fold.callee(attrs, coords, res_coord)
-                    stack.append((goto_state, res_coord, res_attr))
-                case Accept():
-                    assert(len(stack) == 2)
-                    return top_attr
-                case None:
-                    expected = [symbol for symbol, actions
-                                in self.table.action[cur_state].items()
-                                if len(actions) > 0]
-                    raise ParseError(pos=cur.pos.start, unexpected=cur,
-                                     expected=expected)
-
-    def tokenize(self, text):
-        lexer = Lexer(self.terminals, text, self.skipped_domains)
+            cur_state = stack[-1][0]
+            base = action_base[cur_state]
+            if base >= 0 and action_check[base + cur_id] == base:
+                code = action_table[base + cur_id]
+            else:
+                code = action_default[cur_state] \
+                    if default_lookaheads[cur_state * n_terminals + cur_id] else DenseTable.ERROR
+
+            if code > 0:
+                attr = domain.func(lexeme) if lexeme is not None else None
+                chain = unit_chains.get(cur_state * n_symbols + cur_id)
+                token_start, token_end = cur_start, cur_end
+                domain, cur_start, cur_end, lexeme = next_match()
+                cur_id = terminal_ids[id(domain)]
+                if chain is not None and chain[cur_id] >= 0:
+                    code = chain[cur_id] + 1
+                stack.append((code - 1, token_start, token_end, attr))
+            elif code < DenseTable.ACCEPT:
+                rule = -code - 1
+                res_begin, res_end, res_attr = reducers[rule](stack, fold_lines, cur_start)
+                nonterm_id, state = rule_nonterm[rule], stack[-1][0]
+                base = goto_base[nonterm_id]
+                if base >= 0 and goto_check[base + state] == base:
+                    goto_state = goto_table[base + state]
+                else:
+                    goto_state = goto_default[nonterm_id]
+                chain = unit_chains.get(state * n_symbols + n_terminals + nonterm_id)
+                if chain is not None and chain[cur_id] >= 0:
+                    goto_state = chain[cur_id]
+                stack.append((goto_state, res_begin, res_end, res_attr))
+            elif code == DenseTable.ACCEPT:
+                assert(len(stack) == 2)
+                return stack[-1][3]
+            else:
+                expected = [symbol for symbol, actions
+                            in self.table.action[cur_state].items()
+                            if len(actions) > 0]
+                cur = Token(domain, cur_start, cur_end, None, lines, lexeme)
+                raise ParseError(pos=lines.position(cur.start), unexpected=cur,
+                                 expected=expected)
+
+    def tokenize(self, text, errors=None):
+        return self.__tokenize(self.__make_lexer(text, errors=errors))
 
+    def tokenize_file(self, path, encoding='utf-8', errors=None):
+        with self.__file_lexer(path, encoding, errors) as lexer:
+            yield from self.__tokenize(lexer)
+
+    def tokenize_stream(self, fileobj, encoding='utf-8', errors=None):
+        return self.__tokenize(self.__make_lexer('', read_text_chunks(fileobj, encoding),
+                                                 errors))
+
+    @staticmethod
+    def __tokenize(lexer):
         while True:
             token = lexer.next_token()
             yield token
             if token.type == EOF_SYMBOL:
                 break
 
+    def relex(self, text, old_tokens, edit):
+        return self.__make_lexer(text).relex(old_tokens, edit)
+
+    def tokenize_columnar(self, text, errors=None):
+        lexer = self.__make_lexer(text, errors=errors)
+        terminals = self.table.terminals
+        terminal_ids = self.__terminal_ids
+
+        types, starts, ends = array.array('H'), array.array('I'), array.array('I')
+        attr_indices, attrs = array.array('I'), []
+        while True:
+            match = lexer.next_match()
+            if match is None:
+                break
+            domain, start, end, lexeme = match
+            attr = domain.func(lexeme) if lexeme is not None else None
+            if attr is not None:
+                attr_indices.append(len(types))
+                attrs.append(attr)
+            types.append(terminal_ids[domain])
+            starts.append(start)
+            ends.append(end)
+
+        types.append(terminal_ids[EOF_SYMBOL])
+        starts.append(lexer.base + lexer.offset)
+        ends.append(lexer.base + lexer.offset)
+        return ColumnarTokens(terminals, types, starts, ends, attr_indices, attrs,
+                              lexer.lines)
+
     def is_lalr_one(self):
         return self.table.is_lalr_one()
 
     def print_table(self, file=sys.stdout):
         print(self.table.stringify(), file=file)
 
-
-def goto(gr, item_set, inp):
-    result_set = set()
-    for (item, lookahead) in item_set:
-        prod_id, dot = item
-        pname, pbody, plambda = gr.productions[prod_id]
-        if dot == len(pbody) or pbody[dot] != inp:
-            continue
-
-        new_item = ((prod_id, dot + 1), lookahead)
-        result_set.add(new_item)
-
-    result_set = closure(gr, result_set)
-    return result_set
+    def print_build_stats(self, file=sys.stdout):
+        print(describe_build_stats(self.build_stats), file=file)
 
 
 def kernels(item_set):
@@ -652,6 +1887,20 @@ def describe_parsing_table(table):
     ])
 
 
+def describe_build_stats(stats):
+    def memory_str(peak):
+        return '%12s' % ('-' if peak is None else '%.1f KiB' % (peak / 1024))
+
+    return ''.join([
+        'TABLE BUILD STATISTICS\n',
+        ''.join('%-28s%10.4f s%s\n' % (phase.name, phase.seconds, memory_str(phase.peak_memory))
+                for phase in stats.phases),
+        '%-28s%10.4f s\n' % ('total', stats.seconds),
+        '\n',
+        ''.join('%-28s%10d\n' % (name, value) for name, value in stats.counts.items()),
+    ])
+
+
 RULE_INDEXING_PATTERN = '%-5d%s'
 START_SYMBOL = '$accept'
 
@@ -660,83 +1909,150 @@ STATUS_SR_CONFLICT = 1
 STATUS_RR_CONFLICT = 2
 
 
-class LR0_Automaton:
+class EncodedGrammar:
+    # Table construction works on ints: a symbol is its index in
+    # self.symbols (nonterminals first), an LR(0) item is the index of its
+    # rule's first item plus the dot, and a set of lookaheads is a bitmask
+    # over terminals.
     def __init__(self, gr):
-        self.states = []
-        self.id_from_state = dict()
-        self.goto = dict()
+        self.symbols = gr.symbols + (EOF_SYMBOL, FREE_SYMBOL)
+        self.symbol_ids = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.n_nonterms = len(gr.nonterms)
+        self.eof = self.terminal_mask([self.symbol_ids[EOF_SYMBOL]])
+        self.free = self.terminal_mask([self.symbol_ids[FREE_SYMBOL]])
+        self.closure_calls = 0
+
+        self.item_rule, self.item_dot, self.item_next = [], [], []
+        self.item_first, self.item_nullable = [], []
+        self.rule_start = []
+        self.nt_rules = [[] for nt in gr.nonterms]
+        for prod_index, (pname, pbody, plambda) in enumerate(gr.productions):
+            self.rule_start.append(len(self.item_rule))
+            self.nt_rules[self.symbol_ids[pname]].append(len(self.item_rule))
+            for dot in range(len(pbody) + 1):
+                first = gr.suffix_first_set(prod_index, dot)
+                self.item_rule.append(prod_index)
+                self.item_dot.append(dot)
+                self.item_next.append(self.symbol_ids[pbody[dot]] if dot < len(pbody) else -1)
+                self.item_first.append(self.terminal_mask(self.symbol_ids[symbol]
+                                                          for symbol in first if symbol is not None))
+                self.item_nullable.append(None in first)
+
+        self.nullable = [None in gr.first_set([nt]) for nt in gr.nonterms]
+        # a nonterminal derives some string of terminals iff its FIRST set,
+        # with None for the empty string, is not empty
+        self.productive = [len(gr.first_set([nt])) > 0 for nt in gr.nonterms]
+
+        # starting items of the rules reachable through leading nonterminals
+        self.nt_closure = []
+        for nt in range(self.n_nonterms):
+            seen, queue = {nt}, [nt]
+            for current in queue:
+                for item in self.nt_rules[current]:
+                    symbol = self.item_next[item]
+                    if 0 <= symbol < self.n_nonterms and symbol not in seen:
+                        seen.add(symbol)
+                        queue.append(symbol)
+            self.nt_closure.append(frozenset(item for current in queue
+                                             for item in self.nt_rules[current]))
+
+    def terminal_mask(self, symbols):
+        mask = 0
+        for symbol in symbols:
+            mask |= 1 << (symbol - self.n_nonterms)
+        return mask
+
+    def decode_lookaheads(self, mask):
+        while mask != 0:
+            low = mask & -mask
+            yield self.symbols[low.bit_length() - 1 + self.n_nonterms]
+            mask ^= low
+
+    def decode_item(self, item):
+        return self.item_rule[item], self.item_dot[item]
+
+    def decode_item_set(self, item_set):
+        return frozenset((self.decode_item(item), lookahead)
+                         for item, lookaheads in item_set.items()
+                         for lookahead in self.decode_lookaheads(lookaheads))
+
+    def closure(self, kernel):
+        self.closure_calls += 1
+        result = set(kernel)
+        for item in kernel:
+            symbol = self.item_next[item]
+            if 0 <= symbol < self.n_nonterms:
+                result |= self.nt_closure[symbol]
+        return frozenset(result)
+
+    def closure_lookaheads(self, kernel):
+        # only lookaheads that are new for an item are pushed further
+        self.closure_calls += 1
+        result = dict(kernel)
+        current = dict(kernel)
+        while len(current) > 0:
+            new_elements = {}
+            for item, lookaheads in current.items():
+                nt = self.item_next[item]
+                if not 0 <= nt < self.n_nonterms:
+                    continue
+                following = self.item_first[item + 1]
+                if self.item_nullable[item + 1]:
+                    following |= lookaheads
+                for new_item in self.nt_rules[nt]:
+                    old = result.get(new_item, 0)
+                    if following & ~old != 0:
+                        result[new_item] = old | following
+                        new_elements[new_item] = new_elements.get(new_item, 0) \
+                                                 | (following & ~old)
+            current = new_elements
+        return result
 
-        self.states = [LR0_Automaton.__closure(gr, [(0, 0)])]
-        next_id = 0
 
-        self.id_from_state[self.states[-1]] = next_id
-        next_id += 1
+class LR0_Automaton:
+    def __init__(self, gr, code=None):
+        self.code = code = code or EncodedGrammar(gr)
+        self.item_sets = [code.closure([code.rule_start[0]])]
+        self.id_from_state = {self.item_sets[0]: 0}
+        self.transitions = dict()
+        self.goto = dict()
 
-        seen = set(self.states)
-        set_queue = self.states
+        set_queue = self.item_sets
         while len(set_queue) > 0:
             new_elements = []
             for item_set in set_queue:
                 item_set_id = self.id_from_state[item_set]
-                for symbol in gr.symbols:
-                    next_item_set = LR0_Automaton.__goto(gr, item_set, symbol)
-                    if len(next_item_set) == 0:
-                        continue
-                    if next_item_set not in seen:
-                        new_elements += [next_item_set]
-                        seen.add(next_item_set)
-                        self.states += [next_item_set]
-                        self.id_from_state[self.states[-1]] = next_id
-                        next_id += 1
-                    self.goto[(item_set_id, symbol)] = self.id_from_state[next_item_set]
+                # successors are visited in gr.symbols order to keep state numbering
+                buckets = collections.defaultdict(list)
+                for item in item_set:
+                    if code.item_next[item] >= 0:
+                        buckets[code.item_next[item]].append(item + 1)
+                for symbol in sorted(buckets):
+                    next_item_set = code.closure(buckets[symbol])
+                    if next_item_set not in self.id_from_state:
+                        new_elements.append(next_item_set)
+                        self.id_from_state[next_item_set] = len(self.item_sets)
+                        self.item_sets.append(next_item_set)
+                    next_id = self.id_from_state[next_item_set]
+                    self.transitions[(item_set_id, symbol)] = next_id
+                    self.goto[(item_set_id, code.symbols[symbol])] = next_id
             set_queue = new_elements
 
-    @staticmethod
-    def __closure(gr, item_set):
-        result = set(item_set)
-        set_queue = item_set
-        while len(set_queue) > 0:
-            new_elements = []
-            for itemProdId, dot in set_queue:
-                pname, pbody, plambda = gr.productions[itemProdId]
-                if dot == len(pbody) or pbody[dot] not in gr.nonterms:
-                    continue
-                nt = pbody[dot]
-                nt_offset = gr.nonterm_offset[nt]
-                for idx in range(len(nt.productions)):
-                    new_item_set = (nt_offset + idx, 0)
-                    if new_item_set not in result:
-                        new_elements += [new_item_set]
-                        result.add(new_item_set)
-            set_queue = new_elements
-        return frozenset(result)
-
-
-    @staticmethod
-    def __goto(gr, item_set, inp):
-        result_set = set()
-        for prod_index, dot in item_set:
-            pname, pbody, plambda = gr.productions[prod_index]
-            if dot < len(pbody) and pbody[dot] == inp:
-                result_set.add((prod_index, dot + 1))
-        result_set = LR0_Automaton.__closure(gr, result_set)
-        return result_set
-
-
-    @staticmethod
-    def __kernels(item_set):
-        return frozenset((x, y) for x, y in item_set if y > 0 or x == 0)
-
-    def kstates(self):
-        return [LR0_Automaton.__kernels(st) for st in self.states]
+    def kernel_item_sets(self):
+        return [frozenset(item for item in st if self.code.item_dot[item] > 0 or item == 0)
+                for st in self.item_sets]
 
 
 class LexerError(Error):
     ERROR_SLICE = 10
 
-    def __init__(self, pos, text):
+    def __init__(self, pos, text, offset=None):
         self.pos = pos
-        self.bad = text[pos.offset:pos.offset + self.ERROR_SLICE]
+        if offset is None:
+            offset = pos.offset
+        self.bad = text[offset:offset + self.ERROR_SLICE]
+        if not isinstance(self.bad, str):
+            self.bad = self.bad.decode('ascii')
 
     def __repr__(self):
         return f'LexerError({self.pos!r},{self.bad!r})'
@@ -746,34 +2062,739 @@ class LexerError(Error):
         return f'Не удалось разобрать {self.bad!r}'
 
 
+class LexerSpec:
+    def __init__(self, terminals, skip):
+        self.skip = [Terminal('-skip-', regex, None) for regex in skip]
+        self.error = ErrorTerminal()
+        self.domains = list(terminals) + self.skip + [self.error]
+
+        first_sets = {domain: domain.first_set() for domain in self.domains}
+        first_chars = {domain: domain.first_chars() for domain in self.domains}
+
+        self.always = []
+        self.dispatch = {}
+        for domain in self.domains:
+            chars = first_chars[domain]
+            if chars is None:
+                self.always.append(domain)
+                for candidates in self.dispatch.values():
+                    candidates.append(domain)
+                continue
+            for char in chars:
+                if char not in self.dispatch:
+                    self.dispatch[char] = list(self.always)
+                self.dispatch[char].append(domain)
+
+        for char, candidates in list(self.dispatch.items()):
+            if ord(char) < 128:
+                self.dispatch[ord(char)] = candidates
+
+        self.skip_run = self.__skip_run(terminals, first_sets)
+        # the run of skipped pieces reads what the race of them would
+        self.keeps_lines = all(domain.keeps_lines() for domain in self.domains)
+
+        self.binary = all(getattr(domain, 'bytes_re', True) is not None
+                          and getattr(domain, 'bytes_image', True) is not None
+                          for domain in self.domains + [self.skip_run])
+        self.__dfa = None
+
+    def __skip_run(self, terminals, first_sets):
+        # Consumes a run of skipped pieces in one regex call. Every piece
+        # must start with a character no real terminal can start with, and
+        # at most one skipped domain may start at any character, so the run
+        # ends exactly where the race between all domains would stop skipping.
+        if len(self.skip) == 0:
+            return None
+
+        real_first = set()
+        for terminal in terminals:
+            if first_sets[terminal] is None:
+                return None
+            real_first |= first_sets[terminal]
+
+        skip_first = [first_sets[domain] for domain in self.skip]
+        if any(first is None for first in skip_first):
+            return None
+        for i in range(len(skip_first)):
+            for j in range(i):
+                if first_sets_overlap(skip_first[i], skip_first[j]):
+                    return None
+
+        pieces = '|'.join(f'(?:{domain.regex})' for domain in self.skip)
+        if len(real_first) > 0:
+            guard = ''.join(re.escape(item) if isinstance(item, str) else CATEGORY_ESCAPES[item]
+                            for item in sorted(real_first, key=str))
+            pieces = f'(?![{guard}])(?:{pieces})'
+
+        try:
+            return Terminal('-skip-', f'(?:{pieces})+', None)
+        except re.error:
+            return None
+
+    @property
+    def dfa(self):
+        if self.__dfa is None:
+            self.__dfa = LexerDFA(self.domains[:-1])
+        return self.__dfa
+
+
 class Lexer:
-    def __init__(self, domains, text, skip):
-        self.domains = list(domains)
+    WINDOW = 1 << 16
+
+    def __init__(self, spec, text, dfa=None, chunks=None, errors=None):
+        self.domains = spec.domains
+        self.dispatch = spec.dispatch
+        self.always = spec.always
+        self.skip = frozenset(spec.skip)
+        self.skip_run = spec.skip_run
+        self.error = spec.error
+        self.keeps_lines = spec.keeps_lines
         self.text = text
-        self.pos = Position()
-        self.skip_token = object()
-        self.domains += [Terminal('-skip-', regex, lambda _: self.skip_token)
-                         for regex in skip]
-        self.domains.append(ErrorTerminal())
+        self.lines = LineIndex(text)
+        self.base = 0
+        self.offset = 0
+        self.dfa = dfa
+        self.chunks = chunks
+        # the offset of a newline known to be in the window
+        self.line_end = -1
+        # with an errors list, lexical errors are recorded there and the lexer
+        # resynchronizes at the next character where some domain matches
+        self.errors = errors
+        self.recovering = False
+
+    @property
+    def pos(self):
+        return self.lines.position(self.base + self.offset)
+
+    def checkpoint(self):
+        return LexerCheckpoint(self.base + self.offset, self.pos)
+
+    def restore(self, checkpoint):
+        assert self.chunks is None, 'restore works for in-memory texts only'
+        self.base, self.offset = 0, checkpoint.offset
+        self.recovering = False
+
+    def relex(self, old_tokens, edit):
+        # Every token boundary is a checkpoint: the lexer keeps no state
+        # besides the offset. A token matched before the edit may have
+        # stopped short of it only because of the text the edit changes (an
+        # unterminated string, say). When no domain reads into a line past
+        # the one its match ends on (LexerSpec.keeps_lines), lexing resumes
+        # one token before the first one to end on the line of the edit;
+        # otherwise any token may have read the edited text, and it resumes
+        # from the start. Once a new token ends where an old one did,
+        # shifted by the delta, the lexer stands at the same offset in the
+        # same text and both streams coincide from there.
+        if self.keeps_lines:
+            line_start = self.text.rfind('\n', 0, edit.start) + 1
+            first = max(bisect.bisect_left(old_tokens, line_start, key=lambda t: t.end) - 1, 0)
+        else:
+            first = 0
+        self.restore(LexerCheckpoint(old_tokens[first - 1].end if first > 0 else 0, None))
+
+        delta = edit.delta
+        tokens = []
+        while True:
+            token = self.next_token()
+            tokens.append(token)
+            if token.end >= edit.start + len(edit.text):
+                old_end = token.end - delta
+                i = bisect.bisect_left(old_tokens, old_end, lo=first, key=lambda t: t.end)
+                if i < len(old_tokens) and old_tokens[i].end == old_end \
+                        and old_tokens[i].type == token.type:
+                    break
+            if token.type == EOF_SYMBOL:
+                i = len(old_tokens)
+                break
+
+        pieces = TokenSequence.pieces_of(old_tokens, 0, first, 0) + [(tokens, 0, len(tokens), 0)] \
+            + TokenSequence.pieces_of(old_tokens, i + 1, len(old_tokens), delta)
+        return TokenSequence(pieces, self.lines)
+
+    def __fill(self, wanted):
+        pieces = [self.text[self.offset:]]
+        available = len(pieces[0])
+        while available < wanted:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.chunks = None
+                break
+            self.lines.feed(chunk)
+            pieces.append(chunk)
+            available += len(chunk)
+
+        self.base += self.offset
+        self.offset = 0
+        self.text = ''.join(pieces)
+
+    def __fill_line(self):
+        # A pattern may look ahead and settle for a shorter match when the
+        # window ends first (an unterminated string on a long line). When no
+        # domain reads into a line past the one its match ends on, keeping
+        # the whole current line in the window is enough: a match that reads
+        # further runs to the end of the window and is taken again with more
+        # text. Otherwise there is no telling how far a domain may read
+        # (a([^;]*;)? looks for the ';' through any number of lines), so
+        # the rest of the input is read in.
+        if not self.keeps_lines:
+            while self.chunks is not None:
+                self.__fill(len(self.text) - self.offset + self.WINDOW)
+            return
+        newline = '\n' if isinstance(self.text, str) else b'\n'
+        while True:
+            found = self.text.find(newline, self.offset)
+            if found >= 0:
+                self.line_end = self.base + found
+                return
+            if self.chunks is None:
+                return
+            self.__fill(len(self.text) - self.offset + self.WINDOW)
+
+    def __lexeme(self, begin, end):
+        lexeme = self.text[begin:end]
+        return lexeme if type(lexeme) is str else lexeme.decode('ascii')
+
+    def __dfa_match(self, offset):
+        index, length = self.dfa.match(self.text, offset)
+        if index is None:
+            return self.error, 1
+        return self.domains[index], length
+
+    def __race(self, offset):
+        text = self.text
+        domain, length, priority = self.error, 0, self.error.priority
+        for candidate in self.dispatch.get(text[offset], self.always):
+            cand_length = candidate.match(text, offset)
+            if (cand_length, candidate.priority) > (length, priority):
+                domain, length, priority = candidate, cand_length, candidate.priority
+        return domain, length
 
     def next_token(self):
-        while self.pos.offset < len(self.text):
-            offset = self.pos.offset
-            matches = [(d, d.priority, *d.match(self.text, offset))
-                       for d in self.domains]
-            domain, priority, length, attr = \
-                    max(matches, key=lambda t: (t[2], t[1]))
+        match = self.next_match()
+        if match is None:
+            end = self.base + self.offset
+            return Token(EOF_SYMBOL, end, end, None, self.lines)
+        domain, start, end, lexeme = match
+        return Token(domain, start, end, None, self.lines, lexeme)
+
+    def next_match(self):
+        while True:
+            if self.chunks is not None:
+                if len(self.text) - self.offset < self.WINDOW:
+                    self.__fill(self.WINDOW)
+                if self.base + self.offset > self.line_end:
+                    self.__fill_line()
+
+            offset = self.offset
+            if offset >= len(self.text):
+                break
+
+            if self.skip_run is not None:
+                length = self.skip_run.match(self.text, offset)
+                if length > 0:
+                    if offset + length == len(self.text) and self.chunks is not None:
+                        self.__fill(length + self.WINDOW)
+                    else:
+                        self.offset = offset + length
+                        self.recovering = False
+                    continue
+
+            if self.dfa is not None:
+                domain, length = self.__dfa_match(offset)
+            else:
+                domain, length = self.__race(offset)
 
             assert length > 0
 
-            if attr == ErrorTerminal:
-                raise LexerError(self.pos, self.text)
+            if offset + length == len(self.text) and self.chunks is not None:
+                # the token may continue in the next chunk, match it again
+                self.__fill(length + self.WINDOW)
+                continue
+
+            if domain is self.error:
+                if self.errors is None:
+                    raise LexerError(self.pos, self.text, offset)
+                if not self.recovering:
+                    self.errors.append(LexerError(self.pos, self.text, offset))
+                    self.recovering = True
+                self.offset = offset + 1
+                continue
+
+            self.recovering = False
+            self.offset = offset + length
+            if domain not in self.skip:
+                end = offset + length
+                lexeme = self.__lexeme(offset, end) if domain.func is not None else None
+                return domain, self.base + offset, self.base + end, lexeme
+
+        return None
+
+
+def read_text_chunks(fileobj, encoding='utf-8', size=None):
+    size = size or Lexer.WINDOW
+    decoder = None
+    while True:
+        chunk = fileobj.read(size)
+        if isinstance(chunk, str):
+            if len(chunk) == 0:
+                return
+            yield chunk
+            continue
+
+        if decoder is None:
+            decoder = codecs.getincrementaldecoder(encoding)()
+            decoder = io.IncrementalNewlineDecoder(decoder, translate=True)
+        text = decoder.decode(chunk, final=(len(chunk) == 0))
+        if len(text) > 0:
+            yield text
+        if len(chunk) == 0:
+            return
+
 
-            new_pos = self.pos.shift(self.text[offset:offset + length])
-            frag = Fragment(self.pos, new_pos)
-            self.pos = new_pos
-            if attr != self.skip_token:
-                token = Token(domain, frag, attr)
-                return token
+NON_BINARY_BYTES = re.compile(rb'[\r\x1c-\x1f\x80-\xff]')
+
+
+class UnsupportedRegex(Exception):
+    pass
+
+
+CATEGORY_TESTS = {
+    sre_constants.CATEGORY_DIGIT: lambda c: c.isdecimal(),
+    sre_constants.CATEGORY_SPACE: lambda c: c.isspace(),
+    sre_constants.CATEGORY_WORD: lambda c: c.isalnum() or c == '_',
+}
+
+CATEGORY_NEGATIONS = {
+    sre_constants.CATEGORY_NOT_DIGIT: sre_constants.CATEGORY_DIGIT,
+    sre_constants.CATEGORY_NOT_SPACE: sre_constants.CATEGORY_SPACE,
+    sre_constants.CATEGORY_NOT_WORD: sre_constants.CATEGORY_WORD,
+}
+
+CATEGORY_ESCAPES = {
+    sre_constants.CATEGORY_DIGIT: r'\d',
+    sre_constants.CATEGORY_SPACE: r'\s',
+    sre_constants.CATEGORY_WORD: r'\w',
+}
+
+
+def first_sets_overlap(first1, first2):
+    def overlap(item1, item2):
+        if isinstance(item1, str) and isinstance(item2, str):
+            return item1 == item2
+        elif isinstance(item1, str):
+            return CATEGORY_TESTS[item2](item1)
+        elif isinstance(item2, str):
+            return CATEGORY_TESTS[item1](item2)
+        else:
+            return item1 == item2 or {item1, item2} == {sre_constants.CATEGORY_DIGIT,
+                                                        sre_constants.CATEGORY_WORD}
+
+    return any(overlap(item1, item2) for item1 in first1 for item2 in first2)
+
+
+@functools.lru_cache(maxsize=None)
+def case_closure(chars, flags):
+    # everything re matches with one of chars under flags, with the folds
+    # str case mappings miss (i ~ ı, İ; s ~ ſ; k ~ K)
+    if not flags & re.IGNORECASE or len(chars) == 0:
+        return chars
+    pattern = re.compile('[' + ''.join(map(re.escape, sorted(chars))) + ']',
+                         flags & (re.IGNORECASE | re.ASCII))
+    return chars | frozenset(pattern.findall(cased_chars()))
+
+
+@functools.lru_cache(maxsize=None)
+def cased_chars():
+    # characters that have a case at all: none lies past the supplementary
+    # multilingual plane
+    return ''.join(char for char in map(chr, range(0x20000))
+                   if char.islower() or char.istitle())
+
+
+def regex_keeps_lines(regex, flags=0):
+    # Whether a match attempt never looks into a line past the one its match
+    # ends on: a newline may only be matched by a character, or a repeated
+    # one, at the very end of the regex, so that once it is read the match
+    # cannot end before it. Lexer.relex relies on this.
+    single = (sre_constants.LITERAL, sre_constants.NOT_LITERAL,
+              sre_constants.ANY, sre_constants.IN)
+
+    def matches_newline(op, av, flags):
+        if op is sre_constants.LITERAL:
+            return av == ord('\n')
+        elif op is sre_constants.NOT_LITERAL:
+            return av != ord('\n')
+        elif op is sre_constants.ANY:
+            return bool(flags & re.DOTALL)
+        negate, found = False, False
+        for item_op, item_av in av:
+            if item_op is sre_constants.NEGATE:
+                negate = True
+            elif item_op is sre_constants.LITERAL:
+                found = found or item_av == ord('\n')
+            elif item_op is sre_constants.RANGE:
+                found = found or item_av[0] <= ord('\n') <= item_av[1]
+            elif item_op is sre_constants.CATEGORY and item_av in CATEGORY_TESTS:
+                found = found or CATEGORY_TESTS[item_av]('\n')
+            elif item_op is sre_constants.CATEGORY and item_av in CATEGORY_NEGATIONS:
+                found = found or not CATEGORY_TESTS[CATEGORY_NEGATIONS[item_av]]('\n')
+            else:
+                return True
+        return found != negate
+
+    def node_keeps(op, av, flags, tail):
+        if op in single:
+            return tail or not matches_newline(op, av, flags)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            lo, hi, item = av
+            if len(item) == 1 and item[0][0] in single:
+                return tail or not matches_newline(*item[0], flags)
+            return seq_keeps(item, flags, False)
+        elif op is sre_constants.SUBPATTERN:
+            group, add_flags, del_flags, p = av
+            return seq_keeps(p, (flags | add_flags) & ~del_flags, tail)
+        elif op is sre_constants.BRANCH:
+            return all(seq_keeps(alternative, flags, tail) for alternative in av[1])
+        elif op is sre_constants.AT:
+            return True
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            return seq_keeps(av[1], flags, False)
+        else:
+            return False
+
+    def seq_keeps(subpattern, flags, tail):
+        last = len(subpattern) - 1
+        return all(node_keeps(op, av, flags, tail and i == last)
+                   for i, (op, av) in enumerate(subpattern))
+
+    try:
+        parsed = sre_parse.parse(regex, flags)
+    except re.error:
+        return False
+    return seq_keeps(parsed, parsed.state.flags, True)
+
+
+def regex_first_set(regex, flags=0):
+    def cased(chars, flags):
+        return set(case_closure(frozenset(chars), flags))
+
+    def node_first(op, av, flags):
+        if op is sre_constants.LITERAL:
+            return cased(chr(av), flags), False
+        elif op is sre_constants.IN:
+            chars, categories = set(), set()
+            for item_op, item_av in av:
+                if item_op is sre_constants.LITERAL:
+                    chars.add(chr(item_av))
+                elif item_op is sre_constants.RANGE and item_av[1] - item_av[0] < 256:
+                    chars.update(map(chr, range(item_av[0], item_av[1] + 1)))
+                elif item_op is sre_constants.CATEGORY and item_av in CATEGORY_TESTS:
+                    categories.add(item_av)
+                else:
+                    return None, False
+            return cased(chars, flags) | categories, False
+        elif op is sre_constants.SUBPATTERN:
+            group, add_flags, del_flags, p = av
+            return seq_first(p, (flags | add_flags) & ~del_flags)
+        elif op is sre_constants.BRANCH:
+            chars, nullable = set(), False
+            for alternative in av[1]:
+                alt_chars, alt_nullable = seq_first(alternative, flags)
+                if alt_chars is None:
+                    return None, False
+                chars |= alt_chars
+                nullable = nullable or alt_nullable
+            return chars, nullable
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            lo, hi, item = av
+            chars, nullable = seq_first(item, flags)
+            return chars, nullable or lo == 0
+        elif op in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            return set(), True
+        else:
+            return None, False
+
+    def seq_first(subpattern, flags):
+        chars = set()
+        for op, av in subpattern:
+            node_chars, nullable = node_first(op, av, flags)
+            if node_chars is None:
+                return None, False
+            chars |= node_chars
+            if not nullable:
+                return chars, False
+        return chars, True
+
+    try:
+        parsed = sre_parse.parse(regex, flags)
+    except re.error:
+        return None
+    chars, nullable = seq_first(parsed, parsed.state.flags)
+    return None if chars is None else frozenset(chars)
+
+
+class LexerDFAState:
+    __slots__ = ('nfa_states', 'trans', 'accept')
+
+    def __init__(self, nfa_states, accept):
+        self.nfa_states = nfa_states
+        self.trans = {}
+        self.accept = accept
+
+
+class LexerDFA:
+    # The automaton finds the longest match of every regex, while re stops
+    # at the first alternative that matches: on '$QUOTX' the regex
+    # (\$QUOT|\$[A-Z]+)* matches 5 characters, the automaton 6. So the
+    # winner of a regex that may stop short is matched once more with re,
+    # and if the lengths differ the token is decided as the regex engine
+    # decides it. Literals and runs of single characters never stop short.
+    REPEAT_LIMIT = 32
+    CHAR_NODES = (sre_constants.LITERAL, sre_constants.NOT_LITERAL,
+                  sre_constants.ANY, sre_constants.IN)
+
+    def __init__(self, domains):
+        self.domains = tuple(domains)
+        self.fallback = []
+        self.checked = set()
+
+        self.__eps = []
+        self.__edges = []
+        self.__accepts = {}
+
+        starts = []
+        for index, domain in enumerate(self.domains):
+            start = self.__new_state()
+            try:
+                if isinstance(domain, LiteralTerminal):
+                    end = start
+                    for char in domain.image:
+                        end = self.__char_edge(end, self.__literal_set(ord(char), 0))
+                else:
+                    parsed = sre_parse.parse(domain.regex, domain.re.flags)
+                    end = self.__build(parsed, parsed.state.flags, start)
+                    if not self.__never_stops_short(parsed):
+                        self.checked.add(index)
+            except UnsupportedRegex:
+                self.fallback.append(index)
+                continue
+            self.__accepts[end] = index
+            starts.append(start)
+
+        self.__states = {}
+        self.dead = LexerDFAState(frozenset(), None)
+        self.start = self.__dfa_state(self.__eps_closure(starts))
+
+    def match(self, text, pos):
+        state, index, length = self.start, None, 0
+        i, n = pos, len(text)
+        while i < n:
+            char = text[i]
+            next_state = state.trans.get(char)
+            if next_state is None:
+                next_state = self.__step(state, char)
+            if next_state is self.dead:
+                break
+            state = next_state
+            i += 1
+            if state.accept is not None:
+                index, length = state.accept, i - pos
+
+        for fb_index in self.fallback:
+            fb_length = self.domains[fb_index].match(text, pos)
+            if fb_length > 0 and (index is None or self.__better(fb_index, fb_length, index, length)):
+                index, length = fb_index, fb_length
+
+        if index in self.checked and self.domains[index].match(text, pos) != length:
+            index, length = self.__race(text, pos)
+        return index, length
+
+    def __race(self, text, pos):
+        index, length = None, 0
+        for cand_index, domain in enumerate(self.domains):
+            cand_length = domain.match(text, pos)
+            if cand_length > 0 and (index is None
+                                    or self.__better(cand_index, cand_length, index, length)):
+                index, length = cand_index, cand_length
+        return index, length
+
+    @classmethod
+    def __never_stops_short(cls, parsed):
+        # characters, then at most one greedy run of a single character class
+        nodes = list(parsed)
+        if len(nodes) > 0 and nodes[-1][0] is sre_constants.MAX_REPEAT:
+            lo, hi, item = nodes[-1][1]
+            if len(item) != 1 or item[0][0] not in cls.CHAR_NODES:
+                return False
+            nodes.pop()
+        return all(op in cls.CHAR_NODES for op, av in nodes)
+
+    def __better(self, index1, length1, index2, length2):
+        key1 = (length1, self.domains[index1].priority, -index1)
+        key2 = (length2, self.domains[index2].priority, -index2)
+        return key1 > key2
+
+    def __new_state(self):
+        self.__eps.append([])
+        self.__edges.append([])
+        return len(self.__eps) - 1
+
+    def __char_edge(self, state, charset):
+        target = self.__new_state()
+        self.__edges[state].append((charset, target))
+        return target
+
+    def __build(self, subpattern, flags, state):
+        for op, av in subpattern:
+            state = self.__build_node(op, av, flags, state)
+        return state
+
+    def __build_node(self, op, av, flags, state):
+        if op in (sre_constants.LITERAL, sre_constants.NOT_LITERAL,
+                  sre_constants.ANY, sre_constants.IN):
+            return self.__char_edge(state, self.__charset(op, av, flags))
+        elif op is sre_constants.SUBPATTERN:
+            group, add_flags, del_flags, p = av
+            return self.__build(p, (flags | add_flags) & ~del_flags, state)
+        elif op is sre_constants.BRANCH:
+            end = self.__new_state()
+            for alternative in av[1]:
+                alt_start = self.__new_state()
+                self.__eps[state].append(alt_start)
+                alt_end = self.__build(alternative, flags, alt_start)
+                self.__eps[alt_end].append(end)
+            return end
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            lo, hi, item = av
+            unbounded = (hi == sre_constants.MAXREPEAT)
+            if lo > self.REPEAT_LIMIT or (not unbounded and hi > self.REPEAT_LIMIT):
+                raise UnsupportedRegex(op, av)
+
+            for i in range(lo):
+                state = self.__build(item, flags, state)
+
+            if unbounded:
+                loop = self.__new_state()
+                self.__eps[state].append(loop)
+                body_end = self.__build(item, flags, loop)
+                self.__eps[body_end].append(loop)
+                return loop
+
+            end = self.__new_state()
+            for i in range(hi - lo):
+                self.__eps[state].append(end)
+                state = self.__build(item, flags, state)
+            self.__eps[state].append(end)
+            return end
+        else:
+            raise UnsupportedRegex(op, av)
+
+    @staticmethod
+    def __literal_set(code, flags):
+        char = chr(code)
+        if flags & re.IGNORECASE:
+            return case_closure(frozenset(char), flags).__contains__
+        return char.__eq__
+
+    @staticmethod
+    def __category_test(category, flags):
+        ascii_only = bool(flags & re.ASCII)
+        tests = CATEGORY_TESTS
+
+        if category in tests:
+            test = tests[category]
+            if ascii_only:
+                return lambda c: c.isascii() and test(c)
+            return test
+        elif category in CATEGORY_NEGATIONS:
+            test = LexerDFA.__category_test(CATEGORY_NEGATIONS[category], flags)
+            return lambda c: not test(c)
+        else:
+            raise UnsupportedRegex(category)
+
+    def __charset(self, op, av, flags):
+        if op is sre_constants.LITERAL:
+            return self.__literal_set(av, flags)
+        elif op is sre_constants.NOT_LITERAL:
+            test = self.__literal_set(av, flags)
+            return lambda c: not test(c)
+        elif op is sre_constants.ANY:
+            if flags & re.DOTALL:
+                return lambda c: True
+            return lambda c: c != '\n'
+
+        negate = False
+        tests = []
+        for item_op, item_av in av:
+            if item_op is sre_constants.NEGATE:
+                negate = True
+            elif item_op is sre_constants.LITERAL:
+                tests.append(self.__literal_set(item_av, flags))
+            elif item_op is sre_constants.RANGE:
+                lo, hi = item_av
+                tests.append(lambda c, lo=lo, hi=hi: lo <= ord(c) <= hi)
+            elif item_op is sre_constants.CATEGORY:
+                tests.append(self.__category_test(item_av, flags))
+            else:
+                raise UnsupportedRegex(item_op, item_av)
+
+        if flags & re.IGNORECASE:
+            cased = lambda c: any(test(v) for v in case_closure(frozenset(c), flags)
+                                  for test in tests)
+        else:
+            cased = lambda c: any(test(c) for test in tests)
+
+        if negate:
+            return lambda c: not cased(c)
+        return cased
+
+    def __eps_closure(self, nfa_states):
+        result = set(nfa_states)
+        stack = list(nfa_states)
+        while len(stack) > 0:
+            for target in self.__eps[stack.pop()]:
+                if target not in result:
+                    result.add(target)
+                    stack.append(target)
+        return frozenset(result)
 
-        return Token(EOF_SYMBOL, Fragment(self.pos, self.pos), None)
+    def __dfa_state(self, nfa_states):
+        if len(nfa_states) == 0:
+            return self.dead
+        if nfa_states in self.__states:
+            return self.__states[nfa_states]
+
+        accepting = [self.__accepts[s] for s in nfa_states if s in self.__accepts]
+        accept = None
+        if len(accepting) > 0:
+            accept = max(accepting, key=lambda i: (self.domains[i].priority, -i))
+
+        state = LexerDFAState(nfa_states, accept)
+        self.__states[nfa_states] = state
+        return state
+
+    def __step(self, state, char):
+        targets = set()
+        test_char = char if type(char) is str else chr(char)
+        for nfa_state in state.nfa_states:
+            for charset, target in self.__edges[nfa_state]:
+                if charset(test_char):
+                    targets.add(target)
+        next_state = self.__dfa_state(self.__eps_closure(targets))
+        state.trans[char] = next_state
+        return next_state
+
+
+if __name__ == '__main__':
+    # python parser_edsl.py grammar_module:parser output.py
+    import importlib
+
+    if len(sys.argv) != 3 or ':' not in sys.argv[1]:
+        print(f'usage: {sys.argv[0]} grammar_module:parser output.py', file=sys.stderr)
+        sys.exit(2)
+
+    sys.path.insert(0, os.getcwd())
+    module_name, parser_name = sys.argv[1].split(':', 1)
+    grammar = importlib.import_module(module_name)
+    with open(sys.argv[2], 'w', encoding='utf-8') as output:
+        getattr(grammar, parser_name).generate(grammar, output)
@@ -0,0 +1,236 @@
+import importlib.util
+import io
+import random
+import re
+import types
+
+import pytest
+
+import parser_edsl as pe
+
+
+def test_default_reduction_only_on_valid_lookaheads():
+    # A -> 'a' is the only action after 'a', on 'x' alone: on 'y' the fold
+    # must not run, the error is reported where the baseline table has it
+    calls = []
+    S, A = pe.NonTerminal('S'), pe.NonTerminal('A')
+    S |= A, 'x', lambda a: a
+    S |= 'y', lambda: 'y'
+    A |= 'a', lambda: calls.append('A') or 'A'
+    p = pe.Parser(S)
+    p.add_skipped_domain('\\s')
+
+    assert p.parse('a x') == 'A'
+    calls.clear()
+    with pytest.raises(pe.ParseError) as error:
+        p.parse('a y')
+    assert calls == []
+    assert error.value.pos == pe.Position(2, 1, 3)
+    assert [str(t) for t in error.value.expected] == ["'x'"]
+
+
+@pytest.mark.parametrize('engine', pe.Parser.LEXER_ENGINES)
+def test_ignorecase_folds_beyond_str_case_mappings(engine):
+    # re matches 'ı' and 'İ' with 'i', 'ſ' with 's': the first characters
+    # the lexer dispatches on have to include them
+    names = [('IF', 'if'), ('INT', 'int'), ('STEP', 'step'), ('NAME', '[a-z]+q')]
+    terminals = [pe.Terminal(name, regex, str, re_flags=re.IGNORECASE)
+                 for name, regex in names]
+    S = pe.NonTerminal('S')
+    for terminal in terminals:
+        S |= terminal
+        S |= S, terminal
+    p = pe.Parser(S, lexer_engine=engine)
+    p.add_skipped_domain('\\s')
+
+    text = 'ınt İf ſtep ſq STEP'
+    expected = [next(t.name for t in terminals if t.re.fullmatch(word))
+                for word in text.split()]
+    assert [str(t.type) for t in p.tokenize(text)][:-1] == expected
+
+
+def tokens_or_error(p, text):
+    result = []
+    try:
+        for t in p.tokenize(text):
+            result.append((str(t.type), t.start, t.end, t.attr))
+    except pe.LexerError as e:
+        result.append(e.pos)
+    return result
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_lexer_engines_agree(seed):
+    # keywords against names, alternatives re takes first where the
+    # automaton would go longer, optional tails and case folding
+    def lexer(engine):
+        S = pe.NonTerminal('S')
+        for terminal in (pe.Terminal('NAME', '[a-z]+', str, priority=1),
+                         pe.Terminal('NUMBER', '[0-9]+(\\.[0-9]+)?', float),
+                         pe.Terminal('MACRO', '(\\$QUOT|\\$[A-Z]+)*', str),
+                         pe.Terminal('WHILE', 'while', str, re_flags=re.IGNORECASE),
+                         'if', 'in', '.', '..'):
+            S |= terminal
+            S |= S, terminal
+        p = pe.Parser(S, lexer_engine=engine)
+        p.add_skipped_domain('\\s')
+        return p
+
+    rnd = random.Random(seed)
+    pieces = ['if', 'in', 'int', 'While', 'WHILE', 'x', '1', '2.5', '3.', '..', '.',
+              '$QUOT', '$A', ' ', '\n']
+    text = ''.join(rnd.choice(pieces) for _ in range(40)) + rnd.choice(['', '$QUOTX', '#'])
+    regex, dfa = lexer('regex'), lexer('dfa')
+    assert tokens_or_error(dfa, text) == tokens_or_error(regex, text)
+
+
+@pytest.mark.parametrize('engine', pe.Parser.LEXER_ENGINES)
+@pytest.mark.parametrize('text, edit', [
+    ('a x\ny\nz', pe.TextEdit(7, 7, ';')),
+    ('a {x\ny\n}z\nb', pe.TextEdit(3, 4, '}')),
+    ('a {x\ny\n}z\nb', pe.TextEdit(9, 9, '\n{')),
+    ('{ab}\n{\nb\n', pe.TextEdit(9, 9, '}')),
+])
+def test_relex_matches_full_lexing_with_multiline_tokens(engine, text, edit):
+    # 'a' looks through the following lines for a ';', comments span lines
+    BLOCK = pe.Terminal('BLOCK', 'a([^;]*;)?', str)
+    COMMENT = pe.Terminal('COMMENT', '{[^}]*}', str)
+    ID = pe.Terminal('ID', '[a-z]+', str, priority=1)
+    S = pe.NonTerminal('S')
+    for terminal in (BLOCK, COMMENT, ID):
+        S |= terminal
+        S |= S, terminal
+    p = pe.Parser(S, lexer_engine=engine)
+    p.add_skipped_domain('\\s')
+    p.add_skipped_domain('[{};]')
+
+    new_text = edit.apply(text)
+    relexed = p.relex(new_text, list(p.tokenize(text)), edit)
+    assert [(t.type, t.start, t.end) for t in relexed] \
+        == [(t.type, t.start, t.end) for t in p.tokenize(new_text)]
+
+
+@pytest.mark.parametrize('engine', pe.Parser.LEXER_ENGINES)
+@pytest.mark.parametrize('window', [1, 3, 7])
+def test_stream_matches_text_with_long_lookahead(engine, window, monkeypatch):
+    # 'a' reads on through lines for a ';', well past a small window
+    monkeypatch.setattr(pe.Lexer, 'WINDOW', window)
+    S = pe.NonTerminal('S')
+    for terminal in (pe.Terminal('BLOCK', 'a([^;]*;)?', str),
+                     pe.Terminal('ID', '[a-z]+', str, priority=1)):
+        S |= terminal
+        S |= S, terminal
+    p = pe.Parser(S, lexer_engine=engine)
+    p.add_skipped_domain('\\s')
+    p.add_skipped_domain(';')
+
+    text = 'x a y\nzz\n\nw;\nb a\nq\n'
+    assert [(t.type, t.start, t.end) for t in p.tokenize_stream(io.StringIO(text))] \
+        == [(t.type, t.start, t.end) for t in p.tokenize(text)]
+
+
+def arithmetic(swapped=False):
+    grammar = types.ModuleType('arithmetic')
+    grammar.NUMBER = pe.Terminal('NUMBER', '[0-9]+', int)
+    grammar.Expr, grammar.Term = pe.NonTerminal('Expr'), pe.NonTerminal('Term')
+    alternatives = [(('+', grammar.Term), lambda e, t: e + t),
+                    (('-', grammar.Term), lambda e, t: e - t)]
+    for tail, fold in reversed(alternatives) if swapped else alternatives:
+        grammar.Expr |= grammar.Expr, *tail, fold
+    grammar.Expr |= grammar.Term
+    grammar.Term |= grammar.NUMBER
+    grammar.Term |= '(', grammar.Expr, ')'
+    return grammar
+
+
+def generated_module(grammar, path):
+    p = pe.Parser(grammar.Expr, precedence=[('left', '+', '-')])
+    p.add_skipped_domain('\\s')
+    with open(path, 'w') as f:
+        p.generate(grammar, f)
+    spec = importlib.util.spec_from_file_location(path.stem, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return p, module
+
+
+def test_generated_module_round_trip(tmp_path):
+    grammar = arithmetic()
+    p, module = generated_module(grammar, tmp_path / 'arithmetic_tables.py')
+    loaded = module.load(grammar)
+    for text in ['1 + 2 - 3', '10 - (2 - 3) + 4', '7']:
+        assert loaded.parse(text) == p.parse(text)
+    with pytest.raises(pe.ParseError):
+        loaded.parse('1 + - 2')
+
+
+def test_generated_module_rejects_a_changed_grammar(tmp_path):
+    # the folds are bound by position: with the alternatives swapped the
+    # old tables would subtract on '+'
+    _, module = generated_module(arithmetic(), tmp_path / 'arithmetic_tables.py')
+    with pytest.raises(ValueError):
+        module.load(arithmetic(swapped=True))
+
+
+def test_tables_cache(tmp_path):
+    def parser(grammar):
+        p = pe.Parser(grammar.Expr, precedence=[('left', '+', '-')], cache_dir=tmp_path)
+        p.add_skipped_domain('\\s')
+        return p
+
+    def built(p):
+        return any(phase.name == 'first sets' for phase in p.build_stats.phases)
+
+    first = parser(arithmetic())
+    assert built(first)
+    files = list(tmp_path.iterdir())
+    assert len(files) == 1
+
+    cached = parser(arithmetic())
+    assert not built(cached)
+    assert cached.parse('10 - (2 - 3) + 4') == first.parse('10 - (2 - 3) + 4') == 15
+
+    # with the folds in the other order the cached tables do not fit
+    swapped = parser(arithmetic(swapped=True))
+    assert built(swapped)
+    assert swapped.parse('10 - (2 - 3) + 4') == 15
+    assert [f.name for f in tmp_path.iterdir()] != [f.name for f in files]
+    assert len(list(tmp_path.iterdir())) == 1
+
+    # a broken file is rebuilt
+    (cache_file,) = tmp_path.iterdir()
+    cache_file.write_bytes(b'broken')
+    assert built(parser(arithmetic(swapped=True)))
+    assert not built(parser(arithmetic(swapped=True)))
+
+
+def random_grammar(seed):
+    rnd = random.Random(seed)
+    nonterms = [pe.NonTerminal(f'N{i}') for i in range(rnd.randint(1, 4))]
+    symbols = nonterms + list('abc'[:rnd.randint(1, 3)])
+    for nt in nonterms:
+        for _ in range(rnd.randint(1, 3)):
+            nt |= tuple(rnd.choice(symbols) for _ in range(rnd.randint(0, 3)))
+    return nonterms[0]
+
+
+def non_reduced_grammar():
+    # neither nonterminal derives a string of terminals
+    N0, N1 = pe.NonTerminal('N0'), pe.NonTerminal('N1')
+    N0 |= N1, N0, N0
+    N1 |= N1, 'c'
+    N1 |= N0
+    return N0
+
+
+@pytest.mark.parametrize('start', [non_reduced_grammar()]
+                         + [random_grammar(seed) for seed in range(300)])
+def test_lalr_methods_agree(start):
+    def actions(p):
+        return [{str(t): sorted(map(repr, entries)) for t, entries in row.items()}
+                for row in p.table.action]
+
+    by_relations = pe.Parser(start, lalr_method='relations')
+    by_propagation = pe.Parser(start, lalr_method='propagation')
+    assert by_relations.is_lalr_one() == by_propagation.is_lalr_one()
+    assert actions(by_relations) == actions(by_propagation)
@@ -1,5 +1,9 @@
 import abc
+import argparse
+import concurrent.futures
 import enum
+import functools
+import os
 import re
 import sys
 import typing
@@ -634,7 +638,7 @@ VALNAME = pe.Terminal('VALNAME', "[A-Z][a-zA-Z0-9_]*", str, priority=8)
 
 
 def make_keyword(image):
-    return pe.Terminal(image, image, lambda name: None,
+    return pe.Terminal(image, image, None,
                        priority=10)
 
 
@@ -655,11 +659,10 @@ NFuncBody, NOperators, NOperator, NDeclOperator, NValName, NAssignOperator, NFun
         .split())
 NCondOperator, NCompBranches, NPreConditionLoop, NLoopStep, NPostConditionLoop, NReturnOperator = \
     map(pe.NonTerminal, 'CondOperator CompBranches PreConditionLoop LoopStep PostConditionLoop ReturnOperator'.split())
-NAssertOperator, NExpr, NLogCompOp, NLogCompExpr, NLogOp, NLogExpr, NCmpOp, NCmpExpr, NArithmOp = \
-    map(pe.NonTerminal, 'AssertOperator Expr LogCompOn LogCompExpr LogOp LogExpr CmpOp CmpExpr ArithmOp'.split())
-NArithmExpr, NMulOp, NMulExpr, NDegOp, NDegExpr, NUnaryOp, NUnaryExpr, NNewExpr, NArrVal, NConst, NVarArgName = \
-    map(pe.NonTerminal,
-        'ArithmExpr MulOp MulExpr DegOp DegExpr UnaryOp UnaryExpr NewExpr ArrVal Const VarArgName'.split())
+NAssertOperator, NExpr, NLogCompOp, NLogOp, NCmpOp, NArithmOp, NMulOp, NDegOp = \
+    map(pe.NonTerminal, 'AssertOperator Expr LogCompOn LogOp CmpOp ArithmOp MulOp DegOp'.split())
+NUnaryOp, NUnaryExpr, NNewExpr, NArrVal, NConst, NVarArgName = \
+    map(pe.NonTerminal, 'UnaryOp UnaryExpr NewExpr ArrVal Const VarArgName'.split())
 
 NProgram |= NFuncs, lambda funcs: Program(funcs)
 NFuncs |= NFuncs, NFunc, lambda funcs, func: funcs + [func]
@@ -722,17 +725,20 @@ NReturnOperator |= KV_RETURN, NExpr
 
 NAssertOperator |= KV_ASSERT, NExpr
 
-NExpr |= NLogCompExpr
-NExpr |= NLogCompExpr, NLogCompOp, NLogCompExpr, BinOpExpression.create
+NExpr |= NExpr, NLogCompOp, NExpr, pe.Prec(KV_OR), BinOpExpression.create
+NExpr |= NExpr, NLogOp, NExpr, pe.Prec(KV_AND), BinOpExpression.create
+NExpr |= NExpr, NCmpOp, NExpr, pe.Prec('='), BinOpExpression.create
+NExpr |= NExpr, NArithmOp, NExpr, pe.Prec('+'), BinOpExpression.create
+NExpr |= NExpr, NMulOp, NExpr, pe.Prec('*'), BinOpExpression.create
+NExpr |= NExpr, NDegOp, NExpr, pe.Prec('**'), BinOpExpression.create
+NExpr |= NUnaryExpr
+# NExpr |= '-', NExpr, pe.Prec('**'), lambda t: UnOpExpression('-', t)
+
 NLogCompOp |= KV_OR, lambda: 'or'
 NLogCompOp |= KV_XOR, lambda: 'xor'
 
-NLogCompExpr |= NLogExpr
-NLogCompExpr |= NLogCompExpr, NLogOp, NLogExpr, BinOpExpression.create
 NLogOp |= KV_AND, lambda: 'and'
 
-NLogExpr |= NCmpExpr
-NLogExpr |= NLogExpr, NCmpOp, NCmpExpr, BinOpExpression.create
 NCmpOp |= '=', lambda: '='
 NCmpOp |= '<>', lambda: '<>'
 NCmpOp |= '<', lambda: '<'
@@ -740,24 +746,15 @@ NCmpOp |= '>', lambda: '>'
 NCmpOp |= '<=', lambda: '<='
 NCmpOp |= '>=', lambda: '>='
 
-NCmpExpr |= NArithmExpr
-NCmpExpr |= NCmpExpr, NArithmOp, NArithmExpr, BinOpExpression.create
 NArithmOp |= '+', lambda: '+'
 NArithmOp |= '-', lambda: '-'
 
-NArithmExpr |= NMulExpr
-NArithmExpr |= NArithmExpr, NMulOp, NMulExpr, BinOpExpression.create
 NMulOp |= '*', lambda: '*'
 NMulOp |= '/', lambda: '/'
 NMulOp |= KV_MOD, lambda: 'mod'
 
-NMulExpr |= NDegExpr
-NMulExpr |= NDegExpr, NDegOp, NMulExpr, BinOpExpression.create
 NDegOp |= '**', lambda: '**'
 
-NDegExpr |= NUnaryExpr
-# NDegExpr |= '-', NUnaryExpr, lambda t: UnOpExpression('-', t)
-
 NUnaryExpr |= ANYNAME, VarName.create
 NUnaryExpr |= NArrVal
 NUnaryExpr |= NFuncCallOperator
@@ -779,21 +776,80 @@ NType |= KV_BOOL, lambda: ElementaryType(BaseType.Boolean)
 NType |= KV_CHAR, lambda: ElementaryType(BaseType.Char)
 NType |= NType, KV_ARRAY, lambda t: ArrayType(t)
 
-p = pe.Parser(NProgram)
-assert p.is_lalr_one()
+@functools.cache
+def parser():
+    p = pe.Parser(NProgram,
+                  cache_dir=os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__'),
+                  precedence=[('nonassoc', KV_OR, KV_XOR),
+                              ('left', KV_AND),
+                              ('left', '=', '<>', '<', '>', '<=', '>='),
+                              ('left', '+', '-'),
+                              ('left', '*', '/', KV_MOD),
+                              ('right', '**')])
+    assert p.is_lalr_one()
+
+    p.add_skipped_domain('\\s')
 
-p.add_skipped_domain('\\s')
+    p.add_skipped_domain(r'\*.*')
+    return p
 
-p.add_skipped_domain(r'\*.*')
 
-for filename in sys.argv[1:]:
+def check_file(filename):
     try:
-        with open(filename) as f:
-            tree = p.parse(f.read())
-            # pprint(tree)
-            tree.check()
-            print("Программа корректна")
+        tree = parser().parse_file(filename)
+        tree.check()
+        return "Программа корректна"
     except pe.Error as e:
-        print(f'Ошибка {e.pos}: {e.message}')
-    # except Exception as e:
-    #     print(e)
+        return f'Ошибка {e.pos}: {e.message}'
+    except OSError as e:
+        return f'Ошибка: не удалось прочитать {filename}: {e.strerror}'
+    except ValueError as e:
+        # UnicodeDecodeError for a file not in UTF-8
+        return f'Ошибка: не удалось прочитать {filename}: {e}'
+
+
+def file_size(filename):
+    # an unreadable file is reported by check_file, here it only goes last
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+
+def jobs_count(value):
+    try:
+        jobs = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'ожидалось целое число, получено {value!r}')
+    if jobs < 0:
+        raise argparse.ArgumentTypeError(f'число процессов не может быть отрицательным: {jobs}')
+    return jobs if jobs > 0 else os.cpu_count() or 1
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Проверка программ')
+    arg_parser.add_argument('files', nargs='*', help='файлы с программами')
+    arg_parser.add_argument('-j', '--jobs', type=jobs_count, default=1,
+                            help='число процессов (0 - по числу ядер)')
+    args = arg_parser.parse_args()
+
+    if args.jobs == 1 or len(args.files) <= 1:
+        for filename in args.files:
+            print(check_file(filename))
+        return
+
+    # Forked workers inherit the parser built here, spawned ones build it
+    # from the cache once. The largest files go first so that no long one
+    # is left for the end, and the results are printed in the order of the
+    # arguments as soon as they are ready.
+    parser()
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+        futures = {}
+        for filename in sorted(set(args.files), key=file_size, reverse=True):
+            futures[filename] = pool.submit(check_file, filename)
+        for filename in args.files:
+            print(futures[filename].result(), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import argparse
+import importlib.util
+import os
+import subprocess
+import sys
+
+import pytest
+
+LAB = os.path.dirname(os.path.abspath(__file__))
+PARSER_EDSL = os.path.join(LAB, '..', '..', 'module2', 'lab2')
+sys.path.insert(0, PARSER_EDSL)
+
+# module2/lab2 has a main.py of its own
+spec = importlib.util.spec_from_file_location('lab3_main', os.path.join(LAB, 'main.py'))
+main = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(main)
+
+PROGRAMS = {
+    'ok.txt': 'define int Foo (int A, char B)\n'
+              '  int x := 1 + 1;\n'
+              '  * comment line\n'
+              '  x := x - 2 + {16}FF;\n'
+              '  while x > 0 do x := x - 1; end;\n'
+              'end\n',
+    'undeclared.txt': 'define int Foo (int A)\n'
+                      '  int x := 1;\n'
+                      '  y := 3;\n'
+                      'end\n',
+    'empty.txt': '',
+}
+
+
+@pytest.fixture
+def programs(tmp_path):
+    for name, text in PROGRAMS.items():
+        (tmp_path / name).write_text(text, encoding='utf-8')
+    (tmp_path / 'latin1.txt').write_bytes('define int Foo (int \xc4)\nend\n'.encode('latin-1'))
+    return tmp_path
+
+
+def test_check_file(programs):
+    assert main.check_file(str(programs / 'ok.txt')) == 'Программа корректна'
+    assert main.check_file(str(programs / 'undeclared.txt')).startswith('Ошибка (3, 3)')
+
+
+@pytest.mark.parametrize('name', ['missing.txt', 'latin1.txt'])
+def test_check_file_reports_unreadable_files(programs, name):
+    path = str(programs / name)
+    assert main.check_file(path).startswith(f'Ошибка: не удалось прочитать {path}: ')
+
+
+@pytest.mark.parametrize('value, jobs', [('1', 1), ('3', 3), ('0', os.cpu_count() or 1)])
+def test_jobs_count(value, jobs):
+    assert main.jobs_count(value) == jobs
+
+
+@pytest.mark.parametrize('value', ['-1', 'two', ''])
+def test_jobs_count_rejects(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        main.jobs_count(value)
+
+
+def test_parallel_output_matches_sequential(programs):
+    # results come in the order of the arguments whatever finishes first
+    files = [str(programs / name)
+             for name in ['undeclared.txt', 'missing.txt', 'ok.txt', 'latin1.txt',
+                          'empty.txt', 'ok.txt']]
+    env = dict(os.environ, PYTHONPATH=PARSER_EDSL)
+
+    def run(*args):
+        return subprocess.run([sys.executable, os.path.join(LAB, 'main.py'), *args, *files],
+                              env=env, capture_output=True, text=True, check=True).stdout
+
+    sequential = run()
+    assert sequential.splitlines() == [main.check_file(f) for f in files]
+    assert run('-j', '2') == sequential
+    assert run('--jobs', '0') == sequential